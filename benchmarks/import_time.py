@@ -0,0 +1,68 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Measure the cold import cost of the app the way a new App Engine instance pays it:
+#   python benchmarks/import_time.py [--module main] [--runs 5] [--top 15] [--output results.jsonl]
+# Each run is a fresh interpreter with -X importtime; the slowest imports are reported by
+# cumulative time, and a summary line can be appended to --output to track regressions.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _run_once(module):
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + module],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    wall_ms = (time.perf_counter() - started) * 1000
+    if result.returncode != 0:
+        raise SystemError("import {} failed:\n{}".format(module, result.stderr[-2000:]))
+    imports = []  # (cumulative us, self us, package)
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, package = line[len("import time:"):].split("|")
+        imports.append((int(cumulative_us), int(self_us), package[1:].rstrip()))
+    return wall_ms, imports
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--output", help="append a JSON summary line to this file")
+    args = parser.parse_args()
+
+    runs = [_run_once(args.module) for _ in range(args.runs)]
+    wall = sorted(wall_ms for wall_ms, _ in runs)
+    _, imports = runs[-1]
+    top_level = [i for i in imports if not i[2].startswith(" ")]
+    total_ms = sum(cumulative for cumulative, _, _ in top_level) / 1000
+
+    print("import {}: median wall {:.0f} ms, min {:.0f} ms over {} runs; importtime total {:.0f} ms".format(
+        args.module, wall[len(wall) // 2], wall[0], len(wall), total_ms))
+    print("{:>12} {:>10}  package".format("cumulative", "self"))
+    for cumulative, self_us, package in sorted(imports, reverse=True)[:args.top]:
+        print("{:>9.1f} ms {:>7.1f} ms  {}".format(cumulative / 1000, self_us / 1000, package))
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps({
+                "module": args.module,
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "median_wall_ms": round(wall[len(wall) // 2], 1),
+                "importtime_total_ms": round(total_ms, 1),
+                "modules": len(imports),
+            }) + "\n")
+
+
+if __name__ == "__main__":
+    main()
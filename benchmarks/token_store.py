@@ -0,0 +1,107 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Compare the device token store designs of firestore/token_store.py on the Firestore emulator:
+#   gcloud emulators firestore start --host-port=localhost:8080
+#   FIRESTORE_EMULATOR_HOST=localhost:8080 python benchmarks/token_store.py \
+#       [--stores document,hash_shard,array_shard_tx,array_shard] [--devices 100000] [--workers 32]
+# For every store: registration throughput of new devices, throughput and failures when the
+# same devices re-register concurrently (shard contention), and the time of a full scan and
+# of an incremental TokenSnapshot refresh.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def _clear_emulator(host, project):
+    # the emulator's reset endpoint drops every document of the project
+    response = requests.delete(
+        "http://{}/emulator/v1/projects/{}/databases/(default)/documents".format(host, project)
+    )
+    response.raise_for_status()
+
+
+def _register(store, registrations, workers):
+    # return (seconds, failures)
+    def register(registration):
+        try:
+            store.add_token(*registration)
+            return 0
+        except Exception:
+            return 1
+
+    started = time.perf_counter()
+    # the v2/v3 stores print on every write
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            failures = sum(pool.map(register, registrations))
+    return time.perf_counter() - started, failures
+
+
+def _run(name, devices, workers, host, project):
+    from firestore.token_store import TOKEN_STORES, TokenSnapshot
+
+    _clear_emulator(host, project)
+    store = TOKEN_STORES[name]()
+    device_ids = ["device-{:07d}".format(i) for i in range(devices)]
+
+    seconds, failures = _register(store, [(d, "ExponentPushToken[{}]".format(d)) for d in device_ids], workers)
+    result = {"store": name, "devices": devices, "workers": workers,
+              "register_per_s": round(devices / seconds, 1), "register_failures": failures}
+
+    # every worker re-registers a device of the same few shards at once
+    updated = device_ids[: max(devices // 10, 1)]
+    seconds, failures = _register(store, [(d, "ExponentPushToken[{}-2]".format(d)) for d in updated], workers)
+    result.update(update_per_s=round(len(updated) / seconds, 1), update_failures=failures)
+
+    started = time.perf_counter()
+    scanned = sum(1 for _ in store.scan())
+    result.update(scan_s=round(time.perf_counter() - started, 2), scanned=scanned)
+
+    snapshot = TokenSnapshot(store)
+    snapshot.refresh()
+    _register(store, [(d, "ExponentPushToken[{}-3]".format(d)) for d in device_ids[:100]], workers)
+    started = time.perf_counter()
+    snapshot.refresh()
+    result.update(snapshot_refresh_s=round(time.perf_counter() - started, 3))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stores", default="document,hash_shard,array_shard_tx,array_shard")
+    parser.add_argument("--devices", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--project", default=os.getenv("GOOGLE_CLOUD_PROJECT", "hate-crime-tracker-bench"))
+    parser.add_argument("--output", help="append a JSON line per store to this file")
+    args = parser.parse_args()
+
+    host = os.getenv("FIRESTORE_EMULATOR_HOST")
+    if not host:
+        # the benchmark wipes the database, never run it against a real project
+        raise SystemError("FIRESTORE_EMULATOR_HOST is not set, start the Firestore emulator first")
+    os.environ["GOOGLE_CLOUD_PROJECT"] = args.project
+
+    print("{:>15} {:>12} {:>9} {:>12} {:>9} {:>8} {:>10}".format(
+        "store", "register/s", "failed", "update/s", "failed", "scan s", "refresh s"))
+    for name in args.stores.split(","):
+        result = _run(name, args.devices, args.workers, host, args.project)
+        print("{store:>15} {register_per_s:>12} {register_failures:>9} {update_per_s:>12} "
+              "{update_failures:>9} {scan_s:>8} {snapshot_refresh_s:>10}".format(**result))
+        if result["scanned"] != args.devices:
+            print("  scanned {} devices, expected {}".format(result["scanned"], args.devices))
+        if args.output:
+            with open(args.output, "a") as f:
+                f.write(json.dumps(dict(result, time=time.strftime("%Y-%m-%dT%H:%M:%S"))) + "\n")
+
+
+if __name__ == "__main__":
+    main()
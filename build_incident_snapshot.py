@@ -0,0 +1,21 @@
+import sys
+from datetime import datetime, timezone
+
+from firestore.incidents import INCIDENT_SNAPSHOT_DIR, Incident
+from firestore.incident_snapshot import writeSnapshot
+
+# Write all incidents (with translations) into the memory-mapped snapshot loaded at cold start
+#   python build_incident_snapshot.py [directory]
+
+
+def main(path):
+    # incidents created or upserted while reading are re-applied on top of the snapshot, since
+    # created_on > watermark (field updates are not, see firestore/incident_snapshot.py)
+    watermark = datetime.now(timezone.utc)
+    incidents = [incident.to_dict() for incident in Incident.collection.fetch()]
+    writeSnapshot(path, incidents, watermark)
+    print("Wrote {} incidents to {}, watermark {}".format(len(incidents), path, watermark.isoformat()))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else INCIDENT_SNAPSHOT_DIR)
@@ -0,0 +1,27 @@
+import threading
+
+# Registry of heavyweight clients (gRPC channels, firebase apps, HTTP sessions) that are
+# created on first use instead of at import time, so cold starts only pay for the
+# services a request actually touches.
+#
+#   register_client("translate", lambda: TranslationServiceClient())
+#   get_client("translate").translate_text(...)
+
+_FACTORIES = {}
+_CLIENTS = {}
+_LOCK = threading.RLock()
+
+
+def register_client(name, factory):
+    _FACTORIES[name] = factory
+
+
+def get_client(name):
+    client = _CLIENTS.get(name)
+    if client is None:
+        with _LOCK:
+            if name not in _CLIENTS:
+                print("Creating client:", name)
+                _CLIENTS[name] = _FACTORIES[name]()
+            client = _CLIENTS[name]
+    return client
@@ -0,0 +1,43 @@
+import gzip
+import hashlib
+
+from flask import Response, current_app, json
+
+try:
+    import brotli
+except ImportError:  # optional, responses are then only offered as gzip
+    brotli = None
+
+
+class EncodedResponse:
+    """A JSON response encoded once, with its gzip/brotli variants and strong ETags.
+
+    Meant to be cached: serving it again only picks the variant the client accepts,
+    or answers 304 when the client already has it (If-None-Match).
+    """
+
+    def __init__(self, payload, status=200):
+        # the same bytes jsonify would produce
+        body = (json.dumps(payload, separators=(",", ":")) + "\n").encode("utf-8")
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.status = status
+        self.bodies = {"identity": body, "gzip": gzip.compress(body)}
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(body)
+        # strong ETags have to differ between content codings of the same resource
+        self.etags = {
+            encoding: digest if encoding == "identity" else f"{digest}-{encoding}" for encoding in self.bodies
+        }
+
+    def to_response(self, request) -> Response:
+        encoding = request.accept_encodings.best_match([e for e in ("br", "gzip") if e in self.bodies], default="identity")
+        etag = self.etags[encoding]
+        if self.status == 200 and request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(self.bodies[encoding], status=self.status, mimetype=current_app.config["JSONIFY_MIMETYPE"])
+            if encoding != "identity":
+                response.headers["Content-Encoding"] = encoding
+        response.set_etag(etag)
+        response.vary.add("Accept-Encoding")
+        return response
@@ -1,28 +1,117 @@
-from datetime import datetime
-import firebase_admin
-from cachetools import TTLCache, cached
-from firebase_admin import db
+import functools
+from datetime import date, datetime
 
-ADMIN_CACHE = TTLCache(maxsize=128, ttl=3600 * 24)
-INCIDENT_CACHE = TTLCache(maxsize=1024, ttl=3600 * 24)
-INCIDENT_STATS_CACHE = TTLCache(maxsize=1024, ttl=3600 * 24)
+import cachetools
+from cachetools import TTLCache
+from cachetools.keys import hashkey
+
+from clients import get_client, register_client
+
+
+class CountingTTLCache(TTLCache):
+    """TTLCache with the lookup counts of the @cached functions using it, for cache_stats()"""
+
+    def __init__(self, maxsize, ttl):
+        super().__init__(maxsize=maxsize, ttl=ttl)
+        self.lookups = 0
+        self.misses = 0
+
+    @property
+    def hits(self):
+        return self.lookups - self.misses
+
+    def __setitem__(self, key, value):
+        # Listen for invalidations from other instances as soon as this one caches anything
+        get_client("cache_update_db_ref")
+        super().__setitem__(key, value)
+
+
+def cached(cache, key=hashkey):
+    """cachetools.cached that counts lookups and misses on cache.
+
+    Counting in the decorator rather than in cache.__getitem__ keeps get(), pop(), values()
+    and the evictions, which cachetools also routes through self[key], out of the hit rate.
+    """
+    def decorator(func):
+        def counting_key(*args, **kwargs):
+            cache.lookups += 1
+            return key(*args, **kwargs)
+
+        def miss(*args, **kwargs):
+            cache.misses += 1
+            return func(*args, **kwargs)
+
+        return functools.update_wrapper(cachetools.cached(cache, key=counting_key)(miss), func)
+    return decorator
+
+
+ADMIN_CACHE = CountingTTLCache(maxsize=128, ttl=3600 * 24)
+INCIDENT_CACHE = CountingTTLCache(maxsize=1024, ttl=3600 * 24)
+INCIDENT_INDEX_CACHE = CountingTTLCache(maxsize=1, ttl=3600 * 24)
+INCIDENT_STATS_CACHE = CountingTTLCache(maxsize=1024, ttl=3600 * 24)
+# Encoded /incidents and /stats responses, keyed on (IncidentQuery, ...)
+INCIDENT_VIEW_CACHE = CountingTTLCache(maxsize=1024, ttl=3600 * 24)
 
 last_cache_update_date = ""
+_initial_event_received = False
 
 
 def __clear_cache():
     ADMIN_CACHE.clear()
+    INCIDENT_INDEX_CACHE.clear()
     INCIDENT_CACHE.clear()
     INCIDENT_STATS_CACHE.clear()
+    INCIDENT_VIEW_CACHE.clear()
+
+
+# Called with the scopes of a scoped flush before the query caches are evicted, so that
+# shared datasets (e.g. the incident index) can patch the written incidents in place
+SCOPED_UPDATE_HANDLERS = []
+
+
+def _overlaps(query, scope) -> bool:
+    # query is the IncidentQuery a cache entry is keyed on, scope an incident write
+    day = date.fromisoformat(scope["day"])
+    return (
+        query.start <= day <= query.end
+        and query.state in ("", scope["state"])
+        and query.type in ("both", scope["type"])
+    )
+
+
+def evict_cache(scopes):
+    """Evict the cached queries and stats of this instance overlapping one of the scopes"""
+    for cache in (INCIDENT_CACHE, INCIDENT_STATS_CACHE, INCIDENT_VIEW_CACHE):
+        for key in list(cache.keys()):
+            query = key[0] if key else None
+            # evict anything not keyed on an IncidentQuery, to be safe
+            if not hasattr(query, "start") or any(_overlaps(query, scope) for scope in scopes):
+                cache.pop(key, None)
+
+
+def __apply_scoped_update(scopes):
+    for handler in SCOPED_UPDATE_HANDLERS:
+        handler(scopes)
+    evict_cache(scopes)
 
 
 def __listener(event):
-    global last_cache_update_date
-    if event.data == last_cache_update_date:
+    global last_cache_update_date, _initial_event_received
+    # event.data is either a timestamp (flush everything) or {"updated_at": timestamp, "scopes": [...]}
+    updated_at = event.data.get("updated_at") if isinstance(event.data, dict) else event.data
+    if not _initial_event_received:
+        # the first event replays the last update, which happened before anything was cached here
+        _initial_event_received = True
+        last_cache_update_date = updated_at
+        return
+    if updated_at == last_cache_update_date:
         print("Cache update data not changed. Skip.")
         return
-    last_cache_update_date = event.data
-    __clear_cache()
+    last_cache_update_date = updated_at
+    if isinstance(event.data, dict) and event.data.get("scopes"):
+        __apply_scoped_update(event.data["scopes"])
+    else:
+        __clear_cache()
     # can be 'put' or 'patch'
     print("cache_update event type:", event.event_type)
     # relative to the reference, it seems
@@ -37,11 +126,53 @@ options = {
     "databaseURL": "https://hate-crime-tracker-dev-default-rtdb.firebaseio.com/",
     "storageBucket": "hate-crime-tracker.appspot.com",
 }
-filebase_app = firebase_admin.initialize_app(options=options, name=my_app_name)
-cache_update_db_ref = db.reference("/cache_update", app=filebase_app)
-cache_update_db_ref.listen(__listener)
 
 
-def flush_cache():
-    __clear_cache()
-    cache_update_db_ref.set(datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+def _create_firebase_app():
+    import firebase_admin
+    return firebase_admin.initialize_app(options=options, name=my_app_name)
+
+
+def _create_cache_update_db_ref():
+    from firebase_admin import db
+    cache_update_db_ref = db.reference("/cache_update", app=get_client("firebase_app"))
+    cache_update_db_ref.listen(__listener)
+    return cache_update_db_ref
+
+
+register_client("firebase_app", _create_firebase_app)
+register_client("cache_update_db_ref", _create_cache_update_db_ref)
+
+
+def cache_stats():
+    caches = {
+        "admin": ADMIN_CACHE,
+        "incident": INCIDENT_CACHE,
+        "incident_index": INCIDENT_INDEX_CACHE,
+        "incident_stats": INCIDENT_STATS_CACHE,
+        "incident_view": INCIDENT_VIEW_CACHE,
+    }
+    return {
+        name: {"hits": cache.hits, "misses": cache.misses, "size": len(cache), "maxsize": cache.maxsize}
+        for name, cache in caches.items()
+    }
+
+
+def flush_cache(scopes=None):
+    """Invalidate the caches on every instance.
+
+    scopes is a list of {"id", "day", "state", "type"} describing the written incidents (old and
+    new values); only cache entries whose query overlaps one of them are evicted. Without scopes
+    every cache is cleared.
+    """
+    global last_cache_update_date
+    # skip the echo of our own update in __listener
+    last_cache_update_date = datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    if scopes is None:
+        __clear_cache()
+        get_client("cache_update_db_ref").set(last_cache_update_date)
+        return
+    if not scopes:
+        return
+    __apply_scoped_update(scopes)
+    get_client("cache_update_db_ref").set({"updated_at": last_cache_update_date, "scopes": scopes})
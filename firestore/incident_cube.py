@@ -0,0 +1,154 @@
+import threading
+from collections import Counter
+from datetime import date, timedelta
+
+from firestore.incident_index import to_naive_utc
+from firestore.incident_query import VALID_INCIDENT_TYPES, normalizeSelfReportStatus, normalizeType
+
+# Base cell of the cube, counted at every (time level, nation) level below
+CUBE_DIMENSIONS = ("day", "state", "type", "self_report_status", "incident_source")
+# Rollups of day, besides the base dimensions. Leaving state out of group_by is the nation level
+TIME_LEVELS = {
+    "day": lambda day: day.isoformat(),
+    "week": lambda day: (day - timedelta(days=day.weekday())).isoformat(),  # monday of the ISO week
+    "month": lambda day: day.strftime("%Y-%m"),
+    "year": lambda day: day.strftime("%Y"),
+}
+GROUP_BY_DIMENSIONS = set(TIME_LEVELS) | set(CUBE_DIMENSIONS)
+FILTER_DIMENSIONS = set(CUBE_DIMENSIONS) - {"day"}
+STATUS = CUBE_DIMENSIONS.index("self_report_status")
+# The cells of a level start their day at the first day of the period
+PERIOD_START = {
+    "day": lambda day: day,
+    "week": lambda day: day - timedelta(days=day.weekday()),
+    "month": lambda day: day.replace(day=1),
+    "year": lambda day: day.replace(month=1, day=1),
+}
+# The time levels the counts of a level can be grouped by (weeks straddle months and years)
+GROUPABLE_TIME_LEVELS = {
+    "day": set(TIME_LEVELS),
+    "week": {"week"},
+    "month": {"month", "year"},
+    "year": {"year"},
+}
+# (time level, nation): the nation levels count every state under ""
+LEVELS = [(time_level, nation) for time_level in PERIOD_START for nation in (False, True)]
+
+
+def _cell(incident):
+    # like the incident index and the rollups, only news and self-reports are counted
+    if not incident or not incident.get("incident_time") or incident.get("type") not in VALID_INCIDENT_TYPES:
+        return None
+    type = incident["type"]
+    return (
+        to_naive_utc(incident["incident_time"]).date(),
+        incident.get("incident_location") or "",
+        type,
+        # news incidents are never moderated, so their self_report_status is meaningless
+        (incident.get("self_report_status") or "") if type == "self_report" else "",
+        incident.get("incident_source") or "",
+    )
+
+
+def parseCubeQuery(group_by="", filter=""):
+    """Parse group_by=month,state and filter=type:news,state:NY request arguments.
+
+    Return (group_by tuple, filters tuple of (dimension, value)); raise ValueError with a
+    user facing message for unknown dimensions or values. Like normalizeQuery, the filters
+    always hold a self_report_status: approved unless requested, or all when grouped on it.
+    """
+    group_by = tuple(dict.fromkeys(d.strip() for d in (group_by or "").split(",") if d.strip()))
+    unknown = [d for d in group_by if d not in GROUP_BY_DIMENSIONS]
+    if unknown:
+        raise ValueError(f"Invalid group_by: {','.join(unknown)}. Allowed values are {sorted(GROUP_BY_DIMENSIONS)}")
+    filters = {}
+    for item in (filter or "").split(","):
+        if not item.strip():
+            continue
+        dimension, _, value = item.partition(":")
+        dimension, value = dimension.strip(), value.strip()
+        if dimension not in FILTER_DIMENSIONS:
+            raise ValueError(f"Invalid filter: {item}. Allowed dimensions are {sorted(FILTER_DIMENSIONS)}")
+        if dimension == "type":
+            value = normalizeType(value, VALID_INCIDENT_TYPES)
+        if dimension == "self_report_status":
+            value = normalizeSelfReportStatus(value)
+        filters[dimension] = value
+    filters.setdefault("self_report_status", "all" if "self_report_status" in group_by else "approved")
+    return group_by, tuple(sorted(filters.items()))
+
+
+def _aligned(time_level, start, end):
+    # whether [start, end] is made of whole periods of the time level
+    return (start is None or PERIOD_START[time_level](start) == start) and \
+        (end is None or PERIOD_START[time_level](end + timedelta(days=1)) == end + timedelta(days=1))
+
+
+class IncidentCube:
+    """Incident counts per (day, state, type, self_report_status, incident_source) cell.
+
+    The counts are also kept per week, month and year, each with and without the state (the
+    nation levels), so a query only scans the cells of the coarsest level that answers it.
+    Kept in sync by IncidentIndex on every upsert/remove (see IncidentIndex.cube), so it
+    never rescans incidents after it is built.
+    """
+
+    def __init__(self, incidents=()):
+        self._counts = {level: Counter() for level in LEVELS}
+        self._lock = threading.Lock()
+        for incident in incidents:
+            cell = _cell(incident)
+            if cell:
+                self._add(cell, 1)
+
+    def _add(self, cell, delta):
+        day, state = cell[0], cell[1]
+        for (time_level, nation), counts in self._counts.items():
+            level_cell = (PERIOD_START[time_level](day), "" if nation else state) + cell[2:]
+            counts[level_cell] += delta
+            if counts[level_cell] <= 0:
+                del counts[level_cell]
+
+    def update(self, old_incident, new_incident):
+        """Move one count from old_incident's cell to new_incident's; either may be None"""
+        old_cell, new_cell = _cell(old_incident), _cell(new_incident)
+        if old_cell == new_cell:
+            return
+        with self._lock:
+            if old_cell:
+                self._add(old_cell, -1)
+            if new_cell:
+                self._add(new_cell, 1)
+
+    def _level(self, group_by, filters, start, end):
+        nation = "state" not in group_by and "state" not in dict(filters)
+        time_levels = set(group_by) & set(TIME_LEVELS)
+        for time_level in ("year", "month", "week"):
+            if time_levels <= GROUPABLE_TIME_LEVELS[time_level] and _aligned(time_level, start, end):
+                return (time_level, nation)
+        return ("day", nation)
+
+    def query(self, group_by=(), filters=(), start: date = None, end: date = None):
+        """[{<group_by dimension>: value, ..., "count": n}] sorted by the group_by values.
+
+        filters is a tuple of (dimension, value) pairs as returned by parseCubeQuery; start/end
+        bound the day (inclusive).
+        """
+        positions = [(CUBE_DIMENSIONS.index(d), value) for d, value in filters if d != "self_report_status"]
+        # as in the incident index, the status only filters self-reports
+        status = dict(filters).get("self_report_status", "all")
+        groups = Counter()
+        with self._lock:
+            # a period is within [start, end] when its first day is, as the level is aligned to them
+            for cell, count in self._counts[self._level(group_by, filters, start, end)].items():
+                day = cell[0]
+                if (start and day < start) or (end and day > end):
+                    continue
+                if any(cell[i] != value for i, value in positions):
+                    continue
+                if status != "all" and cell[2] == "self_report" and cell[STATUS] != status:
+                    continue
+                groups[tuple(
+                    TIME_LEVELS[d](day) if d in TIME_LEVELS else cell[CUBE_DIMENSIONS.index(d)] for d in group_by
+                )] += count
+        return [dict(zip(group_by, group), count=count) for group, count in sorted(groups.items())]
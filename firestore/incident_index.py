@@ -0,0 +1,219 @@
+import heapq
+import threading
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+
+
+def to_naive_utc(value: datetime) -> datetime:
+    # Firestore returns timezone-aware UTC datetimes while request arguments are naive,
+    # so everything in the index is compared as naive UTC
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def sort_key(incident):
+    return (to_naive_utc(incident["incident_time"]), incident.get("id") or "")
+
+
+def cache_scopes(incident_id, *incidents):
+    """The {id, day, state, type} an incident occupied before and after a write, see flush_cache"""
+    scopes = []
+    for incident in incidents:
+        if not incident or not incident.get("incident_time"):
+            continue
+        scope = {
+            "id": incident_id,
+            "day": to_naive_utc(incident["incident_time"]).strftime("%Y-%m-%d"),
+            "state": incident.get("incident_location") or "",
+            "type": incident.get("type") or "",
+        }
+        if scope not in scopes:
+            scopes.append(scope)
+    return scopes
+
+
+def _newest_first(keys, rows, lo, hi):
+    for i in range(hi - 1, lo - 1, -1):
+        yield keys[i], rows[i]
+
+
+def _partitions_for(location, type, status):
+    # news incidents are never moderated, so their self_report_status is meaningless
+    status = status if type == "self_report" else None
+    return (("", type, status), (location or "", type, status))
+
+
+def _partitions_of(incident):
+    return _partitions_for(incident.get("incident_location"), incident.get("type"), incident.get("self_report_status"))
+
+
+def _without(keys, rows, drop_keys):
+    # copies of keys/rows without drop_keys, slicing around them
+    if not drop_keys:
+        return keys, rows
+    new_keys, new_rows, previous = [], [], 0
+    for i in sorted(bisect_left(keys, key) for key in drop_keys):
+        new_keys += keys[previous:i]
+        new_rows += rows[previous:i]
+        previous = i + 1
+    return new_keys + keys[previous:], new_rows + rows[previous:]
+
+
+def _with(keys, rows, pairs):
+    # copies of keys/rows with the (key, row) pairs, sorted by key, inserted in order
+    if not pairs:
+        return keys, rows
+    new_keys, new_rows, previous = [], [], 0
+    for key, row in pairs:
+        i = bisect_left(keys, key, previous)
+        new_keys += keys[previous:i]
+        new_rows += rows[previous:i]
+        new_keys.append(key)
+        new_rows.append(row)
+        previous = i
+    return new_keys + keys[previous:], new_rows + rows[previous:]
+
+
+class IncidentIndex:
+    """Process-resident copy of all incidents, sorted by incident_time.
+
+    Incidents are partitioned by (incident_location, type, self_report_status), plus an
+    "all states" partition per (type, self_report_status). Every partition keeps a parallel
+    list of (incident_time, id) keys, so a date range is two bisects and a slice.
+
+    Rows are incident dicts, or positions in an IncidentSnapshot that are only decoded
+    when a query returns them.
+    """
+
+    def __init__(self, incidents=(), snapshot=None):
+        self._partitions = {}  # (state, type, self_report_status) : (keys, rows)
+        self._by_id = {}  # id : (key, partitions, row)
+        self._snapshot = snapshot
+        self._cube = None
+        self._write_lock = threading.Lock()  # one writer at a time, readers never wait
+        entries = [(sort_key(incident), _partitions_of(incident), incident) for incident in incidents]
+        if snapshot is not None:
+            entries += [(snapshot.key(i), _partitions_for(*snapshot.partition(i)), i) for i in range(len(snapshot))]
+        entries.sort(key=lambda entry: entry[0])
+        for key, partitions, row in entries:
+            for partition in partitions:
+                keys, rows = self._partitions.setdefault(partition, ([], []))
+                keys.append(key)
+                rows.append(row)
+            self._by_id[key[1]] = (key, partitions, row)
+
+    @property
+    def size(self):
+        return len(self._by_id)
+
+    def _materialize(self, row):
+        return self._snapshot.incident(row) if isinstance(row, int) else row
+
+    # Updates are copy-on-write per partition: readers on other threads keep slicing a
+    # consistent (keys, rows) pair while the new lists are built.
+
+    def get(self, incident_id):
+        entry = self._by_id.get(incident_id)
+        return self._materialize(entry[2]) if entry else None
+
+    def apply(self, upserts=(), removals=()):
+        """Upsert the incidents and remove the ids in one pass per touched partition.
+
+        A burst of changes (a watch snapshot after a bulk import) then costs one copy of
+        every touched partition instead of one per change. Return {id: indexed incident
+        before the change, or None} of the changed ids.
+        """
+        changes = {incident_id: None for incident_id in removals}  # id : new incident or None
+        for incident in upserts:
+            changes[incident["id"]] = incident
+        # the watcher, the cache update listener, request and translation threads all write here
+        with self._write_lock:
+            removed = {}  # partition : keys to drop
+            inserted = {}  # partition : [(key, row)]
+            replaced = {}
+            for incident_id, incident in changes.items():
+                entry = self._by_id.pop(incident_id, None)
+                replaced[incident_id] = self._materialize(entry[2]) if entry else None
+                if entry:
+                    key, partitions, _ = entry
+                    for partition in partitions:
+                        removed.setdefault(partition, []).append(key)
+                if incident is not None:
+                    key, partitions = sort_key(incident), _partitions_of(incident)
+                    for partition in partitions:
+                        inserted.setdefault(partition, []).append((key, incident))
+                    self._by_id[incident_id] = (key, partitions, incident)
+            for partition in set(removed) | set(inserted):
+                keys, rows = self._partitions.get(partition, ([], []))
+                keys, rows = _without(keys, rows, removed.get(partition, ()))
+                pairs = sorted(inserted.get(partition, ()), key=lambda pair: pair[0])
+                self._partitions[partition] = _with(keys, rows, pairs)
+            if self._cube is not None:
+                for incident_id, incident in changes.items():
+                    self._cube.update(replaced[incident_id], incident)
+            return replaced
+
+    def remove(self, incident_id):
+        """Drop the incident from the index, return the removed incident or None"""
+        return self.apply(removals=[incident_id])[incident_id]
+
+    def upsert(self, incident):
+        """Insert the incident, replacing the indexed incident with the same id"""
+        self.apply(upserts=[incident])
+
+    def cube(self):
+        """IncidentCube of the indexed incidents, built on first use and then kept in sync by upsert/remove"""
+        if self._cube is None:
+            from firestore.incident_cube import IncidentCube  # imports this module
+            with self._write_lock:
+                if self._cube is None:
+                    self._cube = IncidentCube(self._materialize(row) for _, _, row in self._by_id.values())
+        return self._cube
+
+    def _slices(self, start: datetime, end: datetime, state, type, self_report_status, before=None):
+        partitions = []
+        if type in ("both", "news"):
+            partitions.append(("news", None))
+        if type in ("both", "self_report"):
+            statuses = ("approved", "new", "rejected") if self_report_status == "all" else (self_report_status,)
+            partitions.extend(("self_report", status) for status in statuses)
+
+        lo_key = (start,)
+        hi_key = (datetime(end.year, end.month, end.day) + timedelta(days=1),)
+        if before is not None:
+            hi_key = min(hi_key, before)
+        for type, status in partitions:
+            keys, rows = self._partitions.get((state, type, status), ([], []))
+            lo = bisect_left(keys, lo_key)
+            hi = bisect_left(keys, hi_key)
+            if lo < hi:
+                yield keys, rows, lo, hi
+
+    def count(self, start: datetime, end: datetime, state="", type="both", self_report_status="approved"):
+        """Number of incidents query() would return without a cursor or limit"""
+        return sum(hi - lo for _, _, lo, hi in self._slices(start, end, state, type, self_report_status))
+
+    def query(self, start: datetime, end: datetime, state="", type="both", self_report_status="approved",
+              before=None, limit=None):
+        """Return incidents in [start, end day] matching the filters, newest first.
+
+        before is an exclusive (incident_time, id) cursor as returned by sort_key(); only the
+        first limit incidents after it are materialized.
+        """
+        slices = list(self._slices(start, end, state, type, self_report_status, before))
+        if not slices:
+            return []
+        if len(slices) == 1:
+            _, rows, lo, hi = slices[0]
+            if limit is not None:
+                lo = max(lo, hi - limit)
+            return [self._materialize(row) for row in rows[lo:hi][::-1]]
+        # walk every partition backwards lazily, so only the returned rows are touched
+        merged = heapq.merge(
+            *[_newest_first(keys, rows, lo, hi) for keys, rows, lo, hi in slices],
+            key=lambda pair: pair[0],
+            reverse=True,
+        )
+        return [self._materialize(row) for _, row in islice(merged, limit)]
@@ -1,5 +1,13 @@
+import os
 from datetime import datetime
 from fireo import models as mdl
+from fireo.database import db
+
+from firestore.incident_index import to_naive_utc
+
+# Targets incident_publisher.py publishes incidents to, and the oldest incident_time it publishes
+PUBLISH_TARGETS = ("notification",)
+PUBLISH_SINCE = datetime(2024, 1, 1)
 
 class IncidentPublishStatus(mdl.Model):
     incident_id = mdl.TextField(required=True)
@@ -29,3 +37,52 @@ def upsertIncidentPublishStatus(incident_update_status: dict):
         return id
     else:
         raise SystemError("Failed to upsert the incident publish status with id:" + incident_update_status.id)
+
+
+def pendingTargets(incident_time, publish_status) -> list:
+    """The PUBLISH_TARGETS an incident still has to be published to, stored as its publish_pending"""
+    if not isinstance(incident_time, datetime) or to_naive_utc(incident_time) < PUBLISH_SINCE:
+        return []
+    return [target for target in PUBLISH_TARGETS if not (publish_status or {}).get(target)]
+
+
+def _publishState():
+    return db.conn.collection(os.getenv('FIRESTORE_COLLECTION', 'incident') + '_publish_state')
+
+
+# Durable progress of incident_publisher.py through incidents written before publish_pending existed
+def _watermarkRef():
+    return _publishState().document("watermark")
+
+
+def getPublishWatermark():
+    """(incident_time, incident id) of the last incident scanned for pending targets, None before the first scan"""
+    doc = _watermarkRef().get()
+    if not doc.exists:
+        return None
+    watermark = doc.to_dict()
+    return watermark["incident_time"], watermark["incident_id"]
+
+
+def setPublishWatermark(batch, incident_time, incident_id):
+    batch.set(_watermarkRef(), {"incident_time": incident_time, "incident_id": incident_id, "updated_on": datetime.now()})
+
+
+# Recipients a partly failed fan-out publish (e.g. push notifications) still has to reach, so
+# that the retries only resend what failed
+def _pendingRecipientsRef(target, incident_id):
+    return _publishState().document("{}_{}".format(target, incident_id))
+
+
+def getPendingRecipients(target, incident_id):
+    """Ids of the recipients still to publish the incident to, None when no publish of it partly failed"""
+    doc = _pendingRecipientsRef(target, incident_id).get()
+    return set(doc.to_dict().get("recipients", [])) if doc.exists else None
+
+
+def setPendingRecipients(target, incident_id, recipients):
+    _pendingRecipientsRef(target, incident_id).set({"recipients": sorted(recipients), "updated_on": datetime.now()})
+
+
+def clearPendingRecipients(target, incident_id):
+    _pendingRecipientsRef(target, incident_id).delete()
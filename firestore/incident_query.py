@@ -0,0 +1,73 @@
+from collections import namedtuple
+from datetime import date, datetime
+
+VALID_SELF_REPORT_STATUSES = {"approved", "rejected", "new"}
+VALID_QUERY_SELF_REPORT_STATUSES = VALID_SELF_REPORT_STATUSES | {"all"}
+
+VALID_INCIDENT_TYPES = {"news", "self_report"}
+VALID_QUERY_INCIDENT_TYPES = VALID_INCIDENT_TYPES | {"both"}
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 1000
+
+# Canonical form of an incident query, used as the cache key of every incident/stats cache.
+# start and end are dates, so any two requests for the same days share one cache entry
+IncidentQuery = namedtuple(
+    "IncidentQuery",
+    ["start", "end", "state", "type", "self_report_status", "start_row", "page_size", "page_token"],
+)
+
+
+def _to_date(value) -> date:
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _to_int(value, default, minimum, maximum=None):
+    value = int(value) if str(value).strip().isdigit() else default
+    value = max(value, minimum)
+    return min(value, maximum) if maximum is not None else value
+
+
+def normalizeType(type, allowed=VALID_QUERY_INCIDENT_TYPES) -> str:
+    """Canonical incident type argument; raise ValueError with a user facing message if not allowed"""
+    # the admin UI spells the type as self-report
+    type = type.strip().lower().replace("-", "_")
+    if type not in allowed:
+        raise ValueError(f"Invalid data type: {type}. Allowed values are {allowed}")
+    return type
+
+
+def normalizeSelfReportStatus(self_report_status) -> str:
+    """Canonical self_report_status argument; raise ValueError with a user facing message if not valid"""
+    self_report_status = self_report_status.strip().lower()
+    if self_report_status not in VALID_QUERY_SELF_REPORT_STATUSES:
+        raise ValueError(f"Invalid self_report_status: {self_report_status}. Allowed values are {VALID_QUERY_SELF_REPORT_STATUSES}")
+    return self_report_status
+
+
+def normalizeQuery(start, end, state="", type="", self_report_status="", start_row="", page_size="", page_token="") -> IncidentQuery:
+    """Validate the query arguments and return their canonical IncidentQuery.
+
+    Raise ValueError with a user facing message for invalid type/self_report_status.
+    """
+    self_report_status = normalizeSelfReportStatus(self_report_status or "approved")
+    type = normalizeType(type or "both")
+    if type == "news":
+        self_report_status = "approved"  # news incidents are not moderated, do not split the cache on it
+    page_token = page_token or ""
+    return IncidentQuery(
+        start=_to_date(start),
+        end=_to_date(end),
+        state=(state or "").strip(),
+        type=type,
+        self_report_status=self_report_status,
+        # a page_token continues after the previous page, start_row is ignored
+        start_row=0 if page_token else _to_int(start_row, 0, 0),
+        page_size=_to_int(page_size, DEFAULT_PAGE_SIZE, 1, MAX_PAGE_SIZE),
+        page_token=page_token,
+    )
+
+
+def statsQuery(query: IncidentQuery) -> IncidentQuery:
+    """The same query without pagination, as stats are always computed over the whole range"""
+    return query._replace(start_row=0, page_size=0, page_token="")
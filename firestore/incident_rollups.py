@@ -0,0 +1,139 @@
+import os
+
+import fireo
+from fireo import models as mdl
+from fireo.database import db
+
+from firestore.incident_index import to_naive_utc
+from firestore.write_batches import writeInBatches
+
+ROLLUP_TYPES = {"news", "self_report"}
+# The only incident fields a rollup cell depends on
+ROLLUP_FIELDS = ["incident_time", "incident_location", "type", "self_report_status"]
+
+
+# Per (day, incident_location) incident counts, maintained on every incident write.
+# news is a count; self_report is { self_report_status : count }
+class IncidentRollup(mdl.Model):
+    day = mdl.TextField(required=True)  # YYYY-MM-DD
+    incident_location = mdl.TextField(required=True)
+    news = mdl.NumberField(default=0)
+    self_report = mdl.MapField(default={})
+
+    class Meta:
+        collection_name = os.getenv('FIRESTORE_COLLECTION', 'incident') + '_daily_rollup'
+
+
+def _rollup_ref(day, state):
+    doc_id = "{}_{}".format(day, state.replace("/", "_"))
+    return db.conn.collection(IncidentRollup.collection_name).document(doc_id)
+
+
+def _rollup_cell(incident):
+    """Return (day, state, counter field path) the incident is counted under, None if not counted"""
+    if not incident or incident.get("type") not in ROLLUP_TYPES or not incident.get("incident_time"):
+        return None
+    day = to_naive_utc(incident["incident_time"]).strftime("%Y-%m-%d")
+    state = incident.get("incident_location") or ""
+    if incident["type"] == "news":
+        return (day, state, "news")
+    return (day, state, "self_report." + (incident.get("self_report_status") or "new"))
+
+
+def _increment(transaction, cell, delta):
+    day, state, field = cell
+    counter = {"news": fireo.Increment(delta)} if field == "news" else \
+        {"self_report": {field.split(".", 1)[1]: fireo.Increment(delta)}}
+    transaction.set(_rollup_ref(day, state), dict(day=day, incident_location=state, **counter), merge=True)
+
+
+def updateRollups(transaction, old_incident, new_incident):
+    """Move one count from old_incident's rollup cell to new_incident's.
+
+    Either incident may be None (insert / delete). Must be called after all reads of the
+    transaction (or with a batch), as it only writes.
+    """
+    old_cell, new_cell = _rollup_cell(old_incident), _rollup_cell(new_incident)
+    if old_cell == new_cell:
+        return
+    if old_cell:
+        _increment(transaction, old_cell, -1)
+    if new_cell:
+        _increment(transaction, new_cell, 1)
+
+
+def rollupCell(incident):
+    """The (day, state, counter field path) cell the incident is counted under, None if not counted"""
+    return _rollup_cell(incident)
+
+
+def addRollups(batch, cell_counts):
+    """Add {cell : count} to the rollups, one write per cell (for bulk inserts)"""
+    for cell, count in cell_counts.items():
+        _increment(batch, cell, count)
+
+
+def queryRollups(start_day: str, end_day: str):
+    """Rollups with start_day <= day <= end_day, as dicts"""
+    rollups = IncidentRollup.collection.filter("day", ">=", start_day).filter("day", "<=", end_day).fetch()
+    return [rollup.to_dict() for rollup in rollups]
+
+
+def streamRollupFields(incident_collection_name):
+    """Stream the ROLLUP_FIELDS of every incident as plain dicts.
+
+    The projection keeps abstracts and translations off the wire, and documents are
+    consumed one at a time from the Firestore iterator, without building models.
+    """
+    query = db.conn.collection(incident_collection_name).select(ROLLUP_FIELDS)
+    for doc in query.stream():
+        yield doc.to_dict()
+
+
+def _expected_rollups(incidents):
+    expected = {}  # (day, state) : {"news": count, "self_report": {status: count}}
+    for incident in incidents:
+        cell = _rollup_cell(incident)
+        if not cell:
+            continue
+        day, state, field = cell
+        counts = expected.setdefault((day, state), {"news": 0, "self_report": {}})
+        if field == "news":
+            counts["news"] += 1
+        else:
+            status = field.split(".", 1)[1]
+            counts["self_report"][status] = counts["self_report"].get(status, 0) + 1
+    return expected
+
+
+def _normalized(rollup):
+    return {
+        "news": rollup.get("news") or 0,
+        "self_report": {k: v for k, v in (rollup.get("self_report") or {}).items() if v},
+    }
+
+
+def rebuildRollups(incidents, fix=False):
+    """Compare stored rollups with counts recomputed from incidents.
+
+    Return the list of (day, state) cells that drifted; when fix is True rewrite them
+    (and delete rollups no incident maps to) in batches.
+    """
+    expected = _expected_rollups(incidents)
+    stored = {}
+    for doc in db.conn.collection(IncidentRollup.collection_name).stream():
+        rollup = doc.to_dict()
+        stored[(rollup.get("day"), rollup.get("incident_location"))] = (doc.reference, _normalized(rollup))
+
+    drifted = [key for key, counts in expected.items() if key not in stored or stored[key][1] != counts]
+    stale = [key for key, (_, counts) in stored.items() if key not in expected and (counts["news"] or counts["self_report"])]
+    drifted += stale
+    if fix:
+        def rewrite(batch, key):
+            if key in expected:
+                day, state = key
+                batch.set(_rollup_ref(day, state), dict(day=day, incident_location=state, **expected[key]))
+            else:
+                batch.delete(stored[key][0])
+        writeInBatches(drifted, rewrite)
+    return drifted
@@ -0,0 +1,141 @@
+import json
+import mmap
+import os
+import threading
+from datetime import datetime
+
+import numpy as np
+from cachetools import LRUCache
+
+from firestore.incident_index import sort_key, to_naive_utc
+
+# Columnar snapshot of the incident collection, written by build_incident_snapshot.py and
+# memory-mapped read-only by every worker, so the pages are shared through the OS page cache:
+#   times.npy           int64 incident_time, microseconds since epoch (naive UTC), ascending
+#   id_offsets.npy      int64 [n+1] offsets of the ids in ids.bin
+#   record_offsets.npy  int64 [n+1] offsets of the JSON incidents (with translations) in records.bin
+#   partitions.npy      int16 [n, 3] codes of (incident_location, type, self_report_status)
+#   meta.json           watermark and the string tables of the partition codes
+# The directory ships with the deploy bundle, so the records leave out PRIVATE_FIELDS.
+#
+# The watermark is compared with created_on, which only new or upserted (insertIncident,
+# insertUserReport) documents set. Field updates (translations, publish status,
+# updateUserReport) and deletes of older incidents are not caught up from it: they reach the
+# index through scoped cache flushes, and everything else with the rebuild after a full flush
+# (see loadIncidentIndex).
+SNAPSHOT_FILES = ("times.npy", "id_offsets.npy", "ids.bin", "record_offsets.npy", "records.bin", "partitions.npy", "meta.json")
+_EPOCH = datetime(1970, 1, 1)
+# contact details of self-reporters
+PRIVATE_FIELDS = ("contact_name", "email", "phone")
+_DATETIME_TAG = "__datetime__"
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return {_DATETIME_TAG: value.isoformat()}
+    return None  # e.g. the SERVER_TIMESTAMP sentinel of an unsaved created_on
+
+
+def _json_object_hook(value):
+    if len(value) == 1 and _DATETIME_TAG in value:
+        return datetime.fromisoformat(value[_DATETIME_TAG])
+    return value
+
+
+def _micros(value: datetime) -> int:
+    delta = to_naive_utc(value) - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _write_heap(path, chunks):
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    with open(path, "wb") as f:
+        for i, chunk in enumerate(chunks):
+            f.write(chunk)
+            offsets[i + 1] = offsets[i] + len(chunk)
+    return offsets
+
+
+def writeSnapshot(path, incidents, watermark: datetime):
+    """Write the incidents as a snapshot directory; watermark is the time the incidents were read"""
+    os.makedirs(path, exist_ok=True)
+    incidents = sorted(incidents, key=sort_key)
+    tables = {"incident_location": [], "type": [], "self_report_status": []}
+    codes = np.zeros((len(incidents), 3), dtype=np.int16)
+    for i, incident in enumerate(incidents):
+        for j, (field, table) in enumerate(tables.items()):
+            value = incident.get(field) or ""
+            if value not in table:
+                table.append(value)
+            codes[i, j] = table.index(value)
+
+    np.save(os.path.join(path, "times.npy"), np.array([_micros(i["incident_time"]) for i in incidents], dtype=np.int64))
+    np.save(os.path.join(path, "id_offsets.npy"),
+            _write_heap(os.path.join(path, "ids.bin"), [(i.get("id") or "").encode("utf-8") for i in incidents]))
+    records = [
+        json.dumps({k: v for k, v in i.items() if k not in PRIVATE_FIELDS}, default=_json_default, ensure_ascii=False)
+        .encode("utf-8")
+        for i in incidents
+    ]
+    np.save(os.path.join(path, "record_offsets.npy"), _write_heap(os.path.join(path, "records.bin"), records))
+    np.save(os.path.join(path, "partitions.npy"), codes)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump({"watermark": watermark.isoformat(), "count": len(incidents), "tables": tables}, f)
+
+
+def _mmap_file(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class IncidentSnapshot:
+    """Read-only, memory-mapped view of a snapshot directory.
+
+    Rows are addressed by position (ascending incident_time); incident(i) decodes one
+    record on demand and keeps recently decoded incidents in a small LRU.
+    """
+
+    def __init__(self, path, decoded_cache_size=4096):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        self.watermark = datetime.fromisoformat(meta["watermark"])
+        self._tables = meta["tables"]
+        self._times = np.load(os.path.join(path, "times.npy"), mmap_mode="r")
+        self._id_offsets = np.load(os.path.join(path, "id_offsets.npy"), mmap_mode="r")
+        self._record_offsets = np.load(os.path.join(path, "record_offsets.npy"), mmap_mode="r")
+        self._partitions = np.load(os.path.join(path, "partitions.npy"), mmap_mode="r")
+        self._ids = _mmap_file(os.path.join(path, "ids.bin"))
+        self._records = _mmap_file(os.path.join(path, "records.bin"))
+        self._decoded = LRUCache(maxsize=decoded_cache_size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def exists(path) -> bool:
+        return all(os.path.exists(os.path.join(path, name)) for name in SNAPSHOT_FILES)
+
+    def __len__(self):
+        return len(self._times)
+
+    def key(self, i):
+        """(incident_time, id) of row i, as sort_key() would return for the decoded incident"""
+        incident_id = self._ids[int(self._id_offsets[i]):int(self._id_offsets[i + 1])]
+        return (_EPOCH + np.timedelta64(int(self._times[i]), "us").item(), bytes(incident_id).decode("utf-8"))
+
+    def partition(self, i):
+        """(incident_location, type, self_report_status) of row i"""
+        return tuple(
+            self._tables[field][int(code)] or None
+            for field, code in zip(("incident_location", "type", "self_report_status"), self._partitions[i])
+        )
+
+    def incident(self, i):
+        with self._lock:
+            incident = self._decoded.get(i)
+        if incident is None:
+            record = self._records[int(self._record_offsets[i]):int(self._record_offsets[i + 1])]
+            incident = json.loads(bytes(record).decode("utf-8"), object_hook=_json_object_hook)
+            with self._lock:
+                self._decoded[i] = incident
+        return incident
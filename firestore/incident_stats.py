@@ -0,0 +1,164 @@
+from datetime import date, datetime
+
+import numpy as np
+
+from firestore.incident_index import to_naive_utc
+
+NEWS, SELF_REPORT = 0, 1
+TYPE_NAMES = ("news", "self_report")
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def _epoch_day(incident_time) -> int:
+    return to_naive_utc(incident_time).toordinal() - _EPOCH_ORDINAL
+
+
+def _day_key(epoch_day) -> str:
+    return date.fromordinal(int(epoch_day) + _EPOCH_ORDINAL).strftime("%Y-%m-%d")
+
+
+def _counts(news, self_report):
+    return {"news": int(news), "self_report": int(self_report)}
+
+
+class StatsColumns:
+    """Columnar (epoch day, state code, type code, count) view of incidents for /stats.
+
+    Every aggregation is a np.bincount over a combined integer code, so building the
+    /stats response is a handful of vectorized passes instead of per-row Python work.
+    """
+
+    def __init__(self, days, states, types, state_names, counts=None):
+        self.days = days  # int32 days since 1970-01-01
+        self.states = states  # int32 index into state_names
+        self.types = types  # int8, NEWS or SELF_REPORT
+        self.state_names = state_names
+        self.counts = np.ones(len(days), dtype=np.int64) if counts is None else counts
+        self._prefix_sums = None
+
+    @classmethod
+    def from_rollups(cls, rollups, type="both", self_report_status="approved"):
+        """Build columns from daily rollups; every (rollup, type) with a count becomes one weighted row"""
+        days, locations, types, counts = [], [], [], []
+        for rollup in rollups:
+            self_report = rollup.get("self_report") or {}
+            by_type = (
+                (rollup.get("news") or 0) if type in ("both", "news") else 0,
+                (sum(self_report.values()) if self_report_status == "all" else self_report.get(self_report_status, 0))
+                if type in ("both", "self_report") else 0,
+            )
+            for type_code, count in enumerate(by_type):
+                if count > 0:
+                    days.append(_epoch_day(datetime.strptime(rollup["day"], "%Y-%m-%d")))
+                    locations.append(rollup["incident_location"] or "")
+                    types.append(type_code)
+                    counts.append(count)
+        state_names, states = np.unique(np.array(locations, dtype=str), return_inverse=True)
+        return cls(
+            np.array(days, dtype=np.int32),
+            states.astype(np.int32),
+            np.array(types, dtype=np.int8),
+            [str(s) for s in state_names],
+            np.array(counts, dtype=np.int64),
+        )
+
+    def _by_type(self, codes, mask, size):
+        # [size, 2] matrix of (news, self_report) counts per code
+        flat = np.bincount(codes[mask] * 2 + self.types[mask], weights=self.counts[mask], minlength=size * 2)
+        return flat.astype(np.int64).reshape(size, 2)
+
+    def daily_by_state(self):
+        """[{key(date), incident_location, news, self_report}], newest day first."""
+        if len(self.days) == 0:
+            return []
+        n_states = max(len(self.state_names), 1)
+        cells, inverse = np.unique(self.days.astype(np.int64) * n_states + self.states, return_inverse=True)
+        counts = self._by_type(inverse.astype(np.int64), np.ones(len(self.days), dtype=bool), len(cells))
+        return [
+            dict(key=_day_key(cell // n_states), incident_location=self.state_names[cell % n_states], **_counts(*row))
+            for cell, row in zip(cells[::-1].tolist(), counts[::-1])
+        ]
+
+    def prefix_sums(self) -> "StatsPrefixSums":
+        """Running counts of these columns, built on first use and kept with the (cached) columns"""
+        if self._prefix_sums is None:
+            self._prefix_sums = StatsPrefixSums(self)
+        return self._prefix_sums
+
+
+def _month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+class StatsPrefixSums:
+    """Running (news, self_report) counts per day and state of a StatsColumns.
+
+    cumulative[i] holds the counts of every day before first_day + i, so the counts of any
+    day range are the difference of two rows, whatever its length: /stats for another date
+    range costs O(states + days returned) instead of a pass over the columns.
+    """
+
+    def __init__(self, columns: StatsColumns):
+        self.state_names = columns.state_names
+        n_states = len(self.state_names)
+        self.first_day = int(columns.days.min()) if len(columns.days) else 0
+        n_days = int(columns.days.max()) - self.first_day + 1 if len(columns.days) else 0
+        daily = np.zeros((n_days, n_states, 2), dtype=np.int64)
+        np.add.at(daily, (columns.days - self.first_day, columns.states, columns.types), columns.counts)
+        self.cumulative = np.zeros((n_days + 1, n_states, 2), dtype=np.int64)
+        np.cumsum(daily, axis=0, out=self.cumulative[1:])
+        # the same over all states, for unfiltered daily/monthly series
+        self.cumulative_all = self.cumulative.sum(axis=1)
+
+    def _rows(self, epoch_days):
+        # row indexes of cumulative for the given epoch days, clamped to the covered days
+        return np.clip(np.asarray(epoch_days, dtype=np.int64) - self.first_day, 0, len(self.cumulative) - 1)
+
+    def range_counts(self, first, last):
+        """[states, 2] counts of the epoch days first..last (inclusive)"""
+        if last < first:
+            return np.zeros(self.cumulative.shape[1:], dtype=np.int64)
+        rows = self._rows([first, last + 1])
+        return self.cumulative[rows[1]] - self.cumulative[rows[0]]
+
+    def _series(self, state):
+        if not state:
+            return self.cumulative_all
+        if state not in self.state_names:
+            return None
+        return self.cumulative[:, self.state_names.index(state)]
+
+    def summarize(self, range_start: date, range_end: date, state=""):
+        """Build the /stats response body.
+
+        stats and total/insight cover [range_start, range_end]; monthly_stats covers the whole
+        months of that range. stats and monthly_stats are filtered by state, total and insight are not.
+        """
+        first = range_start.toordinal() - _EPOCH_ORDINAL
+        last = range_end.toordinal() - _EPOCH_ORDINAL
+
+        insight = {
+            name: _counts(*row) for name, row in zip(self.state_names, self.range_counts(first, last)) if row.sum() > 0
+        }
+        total = {name: value["news"] + value["self_report"] for name, value in insight.items()}
+
+        stats, monthly_stats = [], {}
+        series = self._series(state)
+        if series is not None:
+            daily = np.diff(series[self._rows(np.arange(first, max(last, first - 1) + 2))], axis=0)
+            stats = [
+                dict(key=_day_key(first + day), **_counts(*daily[day]))
+                for day in np.flatnonzero(daily.sum(axis=1))[::-1].tolist()
+            ]
+
+        if series is not None and first <= last:
+            # month boundaries, from the first month of the range to the month after its last
+            months = np.arange(
+                np.datetime64(_month_start(range_start), "M"), np.datetime64(_month_start(range_end), "M") + 2
+            )
+            boundaries = months.astype("datetime64[D]").astype(np.int64)
+            monthly = np.diff(series[self._rows(boundaries)], axis=0)
+            for month in np.flatnonzero(monthly.sum(axis=1))[::-1].tolist():
+                monthly_stats[str(months[month])] = _counts(*monthly[month])
+
+        return {"stats": stats, "total": total, "monthly_stats": monthly_stats, "insight": insight}
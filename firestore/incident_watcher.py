@@ -0,0 +1,64 @@
+import threading
+
+from google.cloud.firestore_v1.watch import ChangeType
+
+from firestore.incident_index import IncidentIndex, cache_scopes
+
+
+class IncidentWatcher:
+    """Live IncidentIndex kept up to date by a Firestore on_snapshot watch.
+
+    The first snapshot (every document of the collection) builds the index; every later
+    snapshot only carries added/modified/removed documents, which are patched into the index
+    in place, all changes of a snapshot at once. on_update is then called with the cache scopes of the patched incidents, so
+    cached query results and stats overlapping them can be evicted.
+
+    With a base_index (loaded from an IncidentSnapshot) the query only covers the documents
+    written since the snapshot watermark, and the first snapshot is patched into base_index.
+    Deletions of older documents are not seen then, so complete is False.
+    """
+
+    def __init__(self, query_ref, to_incident, on_update, base_index=None):
+        self._query_ref = query_ref
+        self._to_incident = to_incident  # DocumentSnapshot -> incident dict
+        self._on_update = on_update
+        self._ready = threading.Event()
+        self._watch = None
+        self.index = base_index
+        self.complete = base_index is None
+
+    def start(self):
+        if self._watch is None:
+            self._watch = self._query_ref.on_snapshot(self._on_snapshot)
+        return self
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+    def wait(self, timeout=None) -> IncidentIndex:
+        """Return the live index once the initial snapshot arrived, None on timeout"""
+        return self.index if self._ready.wait(timeout) else None
+
+    def _on_snapshot(self, documents, changes, read_time):
+        if not self._ready.is_set():
+            if self.index is None:
+                self.index = IncidentIndex([self._to_incident(doc) for doc in documents])
+            else:
+                self.index.apply(upserts=[self._to_incident(doc) for doc in documents])
+            print("Incident watcher loaded {} incidents".format(len(documents)))
+            self._ready.set()
+            return
+
+        # one merge per touched partition for the whole snapshot, however many changes it has
+        removals = [change.document.id for change in changes if change.type == ChangeType.REMOVED]
+        upserts = [self._to_incident(change.document) for change in changes if change.type != ChangeType.REMOVED]
+        replaced = self.index.apply(upserts, removals)
+        new_incidents = {incident["id"]: incident for incident in upserts}
+        scopes = []
+        for incident_id, old_incident in replaced.items():
+            scopes.extend(cache_scopes(incident_id, old_incident, new_incidents.get(incident_id)))
+        if scopes:
+            print("Incident watcher applied {} change(s) at {}".format(len(changes), read_time))
+            self._on_update(scopes)
@@ -1,25 +1,36 @@
+import base64
+import json
 import os
-from datetime import datetime
+import threading
+from collections import Counter
+from datetime import date, datetime
 
 import dateparser
-from cachetools import cached
+import fireo
 from fireo import models as mdl
+from fireo.database import db as fireo_db
+from fireo.queries.query_wrapper import ModelWrapper
 
 from google.cloud import firestore
-from firestore.cachemanager import INCIDENT_CACHE, INCIDENT_STATS_CACHE, flush_cache
+from google.cloud.firestore_v1.field_path import FieldPath
+from firestore.cachemanager import (INCIDENT_CACHE, INCIDENT_INDEX_CACHE, INCIDENT_STATS_CACHE, INCIDENT_VIEW_CACHE,
+                                    SCOPED_UPDATE_HANDLERS, cached, evict_cache, flush_cache)
+from firestore.incident_index import IncidentIndex, cache_scopes, sort_key, to_naive_utc
+from firestore.incident_publish_status import pendingTargets
+from firestore.incident_query import VALID_SELF_REPORT_STATUSES, IncidentQuery, normalizeQuery, statsQuery
+from firestore.incident_rollups import addRollups, queryRollups, rollupCell, updateRollups
+from firestore.incident_snapshot import IncidentSnapshot
+from firestore.incident_watcher import IncidentWatcher
+from firestore.incident_stats import StatsColumns
 from firestore.get_all_validation import get_all_validation
-
-VALID_SELF_REPORT_STATUSES = {"approved", "rejected", "new"}
-VALID_QUERY_SELF_REPORT_STATUSES = VALID_SELF_REPORT_STATUSES | {"all"}
-
-VALID_INCIDENT_TYPES = {"news", "self_report"}
-VALID_QUERY_INCIDENT_TYPES = VALID_INCIDENT_TYPES | {"both"}
+from firestore.write_batches import WRITE_BATCH_SIZE, writeInBatches
 
 class Incident(mdl.Model):
     created_on = mdl.DateTime(auto=True)
     publish_status = mdl.MapField(
         required=True, default={"twitter": None, "linkedin": None, "notification": None}
     )
+    publish_pending = mdl.ListField(required=False)  # targets still to publish to, see incident_publisher.py
     donation_link = mdl.TextField()  # Link to donation website
     police_tip_line = mdl.TextField()  # Phone number to provide tips to police
     help_the_victim = mdl.TextField()  # Text about how people can help the victim
@@ -50,82 +61,238 @@ class Incident(mdl.Model):
 
 
 
+# Keep the incident index live through a Firestore watch instead of reloading it after writes
+WATCH_INCIDENTS = os.getenv('WATCH_INCIDENTS', 'true').lower() == 'true'
+WATCH_INITIAL_SNAPSHOT_TIMEOUT = 60  # seconds
+# Directory written by build_incident_snapshot.py, memory-mapped at cold start when present
+INCIDENT_SNAPSHOT_DIR = os.getenv('INCIDENT_SNAPSHOT_DIR', 'incident_snapshot')
+_incident_watcher = None
+_incident_watcher_lock = threading.Lock()
+_incident_index_loaded = False
+
+
+def _toIncident(doc) -> dict:
+    return ModelWrapper.from_query_result(Incident(), doc).to_dict()
+
+
+def _loadSnapshotIndex():
+    # Index over the memory-mapped snapshot, or None when no snapshot was deployed
+    if not IncidentSnapshot.exists(INCIDENT_SNAPSHOT_DIR):
+        return None, None
+    snapshot = IncidentSnapshot(INCIDENT_SNAPSHOT_DIR)
+    print("Loaded incident snapshot with {} incidents, watermark {}".format(len(snapshot), snapshot.watermark))
+    return IncidentIndex(snapshot=snapshot), snapshot.watermark
+
+
+def incidentWatcher(complete=False) -> IncidentWatcher:
+    # The running watcher; with complete, one over the whole collection, replacing a watcher
+    # that started from the snapshot
+    global _incident_watcher
+    with _incident_watcher_lock:
+        if complete and _incident_watcher is not None and not _incident_watcher.complete:
+            _incident_watcher.stop()
+            _incident_watcher = None
+        if _incident_watcher is None:
+            query = fireo_db.conn.collection(Incident.collection_name)
+            base_index, watermark = (None, None) if complete else _loadSnapshotIndex()
+            if watermark is not None:
+                # only documents created or upserted since the snapshot, see incident_snapshot.py
+                query = query.where("created_on", ">", watermark)
+            _incident_watcher = IncidentWatcher(query, _toIncident, evict_cache, base_index).start()
+    return _incident_watcher
+
+
+@cached(cache=INCIDENT_INDEX_CACHE)
+def loadIncidentIndex() -> IncidentIndex:
+    # One shared, time-sorted copy of every incident; cleared together with the other caches.
+    # The snapshot only speeds up the cold start: it misses edits and deletes of the incidents
+    # it holds that do not go through this app (console edits), so once the index is reloaded
+    # (full cache flush or TTL) it is rebuilt from the whole collection.
+    global _incident_index_loaded
+    use_snapshot = not _incident_index_loaded
+    _incident_index_loaded = True
+    if WATCH_INCIDENTS:
+        index = incidentWatcher(complete=not use_snapshot).wait(WATCH_INITIAL_SNAPSHOT_TIMEOUT)
+        if index is not None:
+            return index
+        print("Incident watcher not ready, loading the incident index directly")
+    index, watermark = _loadSnapshotIndex() if use_snapshot else (None, None)
+    if index is None:
+        incidents = [incident.to_dict() for incident in Incident.collection.fetch()]
+        print("Loaded incident index with {} incidents".format(len(incidents)))
+        return IncidentIndex(incidents)
+    # apply the incidents written since the snapshot on top of it
+    written = Incident.collection.filter("created_on", ">", watermark).fetch()
+    index.apply(upserts=[incident.to_dict() for incident in written])
+    return index
+
+
+def queryIncidentCube(group_by=(), filters=(), start: date = None, end: date = None):
+    # Counts rolled up from the cube of the resident index, which patches it on every change
+    return loadIncidentIndex().cube().query(group_by, filters, start, end)
+
+
+def encodePageToken(incident) -> str:
+    # Opaque keyset cursor: the (incident_time, id) of the last incident of a page
+    incident_time, incident_id = sort_key(incident)
+    return base64.urlsafe_b64encode(json.dumps([incident_time.isoformat(), incident_id]).encode("utf-8")).decode("ascii")
+
+
+def decodePageToken(page_token):
+    # raise ValueError/TypeError for anything encodePageToken did not produce
+    incident_time, incident_id = json.loads(base64.urlsafe_b64decode(page_token.encode("ascii")))
+    if not isinstance(incident_id, str):
+        raise ValueError("page_token id must be a string")
+    # index keys are naive UTC
+    return (to_naive_utc(datetime.fromisoformat(incident_time)), incident_id)
+
+
 @cached(cache=INCIDENT_CACHE)
-def queryIncidents(start: datetime, end: datetime, state="", type="", self_report_status="", start_row="", page_size=""):
-    # Convert start_row and page_size to integers
-    # TODO: implement the pagination based on Firestore (https://firebase.google.com/docs/firestore/query-data/query-cursors)
-    try:
-        # Validate type and self_report_status
-        self_report_status = "approved" if self_report_status == "" else self_report_status
-        if self_report_status not in VALID_QUERY_SELF_REPORT_STATUSES:
-            return {"error": f"Invalid self_report_status: {self_report_status}. Allowed values are {VALID_QUERY_SELF_REPORT_STATUSES}"}
-        type="both" if type == "" else type
-        if type not in VALID_QUERY_INCIDENT_TYPES:
-            return {"error": f"Invalid data type: {type}. Allowed values are {VALID_QUERY_INCIDENT_TYPES}"}
-        start_row = int(start_row) if str(start_row).isdigit() and int(start_row) >= 0 else 0
-        page_size = int(page_size) if str(page_size).isdigit() and int(page_size) > 0 else 1000
-    except ValueError:
-        start_row, page_size = 0, 10  # Default values
-    
-    end_time = datetime(end.year, end.month, end.day, 23, 59, 59)
-    query = Incident.collection.filter("incident_time", ">=", start).filter(
-        "incident_time", "<=", end_time
-    )
-    if state != "":
-        query = query.filter("incident_location", "==", state)
-
-    incidents = []
-
-    if type == "both":
-        all_incidents = list(query.fetch())
-        # Split into news and self_report incidents based on type
-        news_incidents = [i for i in all_incidents if i.type == "news"]
-        self_report_incidents = [i for i in all_incidents if i.type == "self_report"]
-        # For self-reports, only show approved ones unless explicitly requested
-        if not self_report_status:
-            self_report_incidents = [i for i in self_report_incidents if i.self_report_status == "approved"]
-        elif self_report_status != "approved":
-            # If requesting non-approved status, we need to check admin permissions in main.py
-            self_report_incidents = [i for i in self_report_incidents if i.self_report_status == self_report_status]
-        # Merge both queries
-        incidents = sorted(news_incidents + self_report_incidents, key=lambda x: x.incident_time, reverse=True)
+def queryIncidentsPage(query: IncidentQuery):
+    # Cached on the canonical query, see normalizeQuery
+    before = None
+    if query.page_token:
+        try:
+            before = decodePageToken(query.page_token)
+        except (ValueError, TypeError):
+            return {"error": f"Invalid page_token: {query.page_token}"}
+
+    # Answered from the resident index (newest first); cached results share its incident dicts
+    index = loadIncidentIndex()
+    start = datetime(query.start.year, query.start.month, query.start.day)
+    end = datetime(query.end.year, query.end.month, query.end.day)
+    filters = (start, end, query.state, query.type, query.self_report_status)
+    incidents = index.query(*filters, before=before, limit=query.start_row + query.page_size)
+
+    # Apply pagination. If the value of start_row is greater than the length of incidents, return [] (empty set).
+    incidents = incidents[query.start_row:]
+    return {
+        "page_info": {
+            "start_row": query.start_row,
+            "page_size": query.page_size,
+            "total_records": index.count(*filters),
+            "next_page_token": encodePageToken(incidents[-1]) if len(incidents) == query.page_size else None,
+        },
+        "incidents": incidents,
+    }
+
+
+def queryIncidents(start: datetime, end: datetime, state="", type="", self_report_status="", start_row="", page_size="", page_token=""):
+    page = getIncidentsPage(start, end, state, type, self_report_status, start_row, page_size, page_token)
+    return page if "error" in page else page["incidents"]
+
+
+def _incidentRef(incident_id=None):
+    collection = fireo_db.conn.collection(Incident.collection_name)
+    return collection.document(incident_id) if incident_id else collection.document()
 
-    else:
-        if type == "self_report":
-            query = query.filter("type", "==", "self_report")
-            if self_report_status:
-                query = query.filter("self_report_status", "==", self_report_status)
-        elif type == "news":
-            query = query.filter("type", "==", "news")
 
-        incidents = list(query.order("-incident_time").fetch())  # Fetch incidents
+def _refreshIndexedIncidents(scopes):
+    # Patch the written incidents into the resident index instead of reloading it
+    indexes = [
+        index for index in INCIDENT_INDEX_CACHE.values()
+        if not (_incident_watcher and _incident_watcher.complete and index is _incident_watcher.index)
+    ]
+    if not indexes:
+        return  # a live index was already patched by the watcher
+    upserts, removals = [], []
+    for incident_id in {scope["id"] for scope in scopes}:
+        incident = Incident.collection.get(Incident.collection_name + "/" + incident_id)
+        if incident:
+            upserts.append(incident.to_dict())
+        else:
+            removals.append(incident_id)
+    for index in indexes:
+        index.apply(upserts, removals)
+
+
+SCOPED_UPDATE_HANDLERS.append(_refreshIndexedIncidents)
 
-    # Apply pagination. If the value of start_row/page_size is greater than the length of incidents, return [] (empty set).
-    if start_row > 0:
-        incidents = incidents[start_row:]  # Skip first start_row items
-    if page_size:
-        incidents = incidents[:page_size]  # Limit results to page_size
 
-    # Convert all incidents to dictionaries
-    return [incident.to_dict() for incident in incidents] if incidents else []
+def _upsertWithRollups(new_incident):
+    # Upsert the incident and move its daily rollup count in the same transaction.
+    # Return the incident id and the cache scopes touched by the write
+    if not new_incident.id:
+        new_incident.id = _incidentRef().id
+
+    @fireo.transactional
+    def upsert(transaction, new_incident):
+        doc = _incidentRef(new_incident.id).get(transaction=transaction)
+        old_incident = doc.to_dict() if doc.exists else None
+        # None fields are not written, so upsert keeps the stored values for them
+        written = {k: v for k, v in new_incident.to_dict().items() if v is not None}
+        merged_incident = {**(old_incident or {}), **written}
+        new_incident.upsert(transaction=transaction)
+        updateRollups(transaction, old_incident, merged_incident)
+        return cache_scopes(new_incident.id, old_incident, merged_incident)
+
+    scopes = upsert(fireo.transaction(), new_incident)
+    return new_incident.id, scopes
 
 
 def deleteIncident(incident_id):
-    if Incident.collection.delete("incident/" + incident_id):
-        flush_cache()
+    @fireo.transactional
+    def delete(transaction, incident_id):
+        incident_ref = _incidentRef(incident_id)
+        doc = incident_ref.get(transaction=transaction)
+        if not doc.exists:
+            return None
+        transaction.delete(incident_ref)
+        updateRollups(transaction, doc.to_dict(), None)
+        return cache_scopes(incident_id, doc.to_dict())
+
+    scopes = delete(fireo.transaction(), incident_id)
+    if scopes is not None:
+        flush_cache(scopes or None)
         return True
     return False
 
 
-def getIncidents(start: datetime, end: datetime, state="", type="", self_report_status="", start_row="", page_size="", skip_cache=False):
+def updateIncidentTranslations(translations, target_lang):
+    """Write translated titles/abstracts with batched field updates and one scoped cache flush.
+
+    translations is a list of (incident, title, abstract); only title_translate.<lang> and
+    abstract_translate.<lang> are written, the rest of each incident is left untouched.
+    """
+    scopes = []
+
+    def update(batch, translation):
+        incident, title, abstract = translation
+        batch.update(_incidentRef(incident["id"]), {
+            FieldPath("title_translate", target_lang).to_api_repr(): title,
+            FieldPath("abstract_translate", target_lang).to_api_repr(): abstract,
+        })
+        scopes.extend(cache_scopes(incident["id"], incident))
+
+    writeInBatches(translations, update)
+    if scopes:
+        flush_cache(scopes)
+
+
+def clearQueryCaches():
+    # Reload the index and drop the pages/views cached on this instance
+    INCIDENT_INDEX_CACHE.clear()
+    INCIDENT_CACHE.clear()
+    INCIDENT_VIEW_CACHE.clear()
+
+
+def getIncidentsPage(start: datetime, end: datetime, state="", type="", self_report_status="", start_row="", page_size="", page_token="", skip_cache=False):
+    try:
+        query = normalizeQuery(start, end, state, type, self_report_status, start_row, page_size, page_token)
+    except ValueError as e:
+        return {"error": str(e)}
     if skip_cache:
-        INCIDENT_CACHE.clear()
-    return queryIncidents(start, end, state, type, self_report_status, start_row, page_size)
+        clearQueryCaches()
+    return queryIncidentsPage(query)
 
 
-def insertIncident(incident, to_flush_cache=True):
-    # return incident id
-    print("INSERTING:", incident)
+def getIncidents(start: datetime, end: datetime, state="", type="", self_report_status="", start_row="", page_size="", skip_cache=False):
+    page = getIncidentsPage(start, end, state, type, self_report_status, start_row, page_size, skip_cache=skip_cache)
+    return page if "error" in page else page["incidents"]
+
+
+def newIncident(incident) -> Incident:
+    # Incident model of an incident dict, as written by insertIncident
     new_incident = Incident(
         incident_time=(
             dateparser.parse(incident["incident_time"])
@@ -150,6 +317,7 @@ def insertIncident(incident, to_flush_cache=True):
     new_incident.publish_status = (
         incident["publish_status"] if "publish_status" in incident else {}
     )
+    new_incident.publish_pending = pendingTargets(new_incident.incident_time, new_incident.publish_status)
     new_incident.donation_link = (
         incident["donation_link"] if "donation_link" in incident else None
     )
@@ -159,58 +327,72 @@ def insertIncident(incident, to_flush_cache=True):
     new_incident.help_the_victim = (
         incident["help_the_victim"] if "help_the_victim" in incident else None
     )
+    return new_incident
+
 
-    incident_id = new_incident.upsert().id
+def insertIncident(incident, to_flush_cache=True):
+    # return incident id
+    print("INSERTING:", incident)
+    new_incident = newIncident(incident)
+    incident_id, scopes = _upsertWithRollups(new_incident)
     if incident_id:
         if to_flush_cache:
-            flush_cache()
+            flush_cache(scopes or None)
         return incident_id
     else:
         raise SystemError("Failed to upsert the incident with id:" + new_incident.id)
 
 
-# Query incidents within the given dates and state
-# Return [ { key: date, value : count, incident_location: state } ]
+def createIncidents(incidents):
+    """Create new incidents (Incident models with ids) and their rollup counts in one WriteBatch.
+
+    Incidents whose id already exists, or repeats within the batch, are skipped, so a batch
+    can be replayed without counting anything twice. The caches are not flushed; return the
+    ids created.
+    """
+    unique = {}
+    for incident in incidents:
+        unique.setdefault(incident.id, incident)
+    incidents = list(unique.values())
+    refs = [_incidentRef(incident.id) for incident in incidents]
+    existing = {doc.id for doc in fireo_db.conn.get_all(refs, field_paths=["incident_time"]) if doc.exists}
+    created = [incident for incident in incidents if incident.id not in existing]
+    cells = Counter(cell for cell in (rollupCell(incident.to_dict()) for incident in created) if cell)
+    if len(created) + len(cells) > WRITE_BATCH_SIZE:
+        raise ValueError("{} incidents and {} rollup cells do not fit in one batch".format(len(created), len(cells)))
+    if not created:
+        return []
+    batch = fireo_db.conn.batch()
+    for incident in created:
+        incident.save(batch=batch)
+    addRollups(batch, cells)
+    batch.commit()
+    return [incident.id for incident in created]
+
+
+# Aggregate the daily rollups within the given dates and state, as columns ready for vectorized aggregation
 
 
 @cached(cache=INCIDENT_STATS_CACHE)
-def getStats(start: datetime, end: datetime, state="", type="", self_report_status=""):
-    stats = {}  # (date, state) : {"news": count, "self_report": count}
-    incidents = queryIncidents(start, end, state, type, self_report_status)
-    
-    # Check if we got an error response
-    if isinstance(incidents, dict) and "error" in incidents:
-        return []
-        
-    for incident in incidents:
-        # Handle both string and datetime inputs
-        incident_time = incident["incident_time"]
-        if isinstance(incident_time, str):
-            incident_time = dateparser.parse(incident_time)
-        incident_date = incident_time.strftime("%Y-%m-%d")
-        key = (incident_date, incident["incident_location"])
-        
-        if key not in stats:
-            stats[key] = {"news": 0, "self_report": 0}
-        
-        # Count the incidents by type for frontend display
-        incident_type = incident.get("type", "news")  # Default to news if type not specified
-        if incident_type == "self_report":
-            stats[key]["self_report"] += 1
-        else:
-            stats[key]["news"] += 1
-
-    ret = []
-    for key in stats:
-        (date, state) = key
-        ret.append({
-            "key": date,
-            "incident_location": state,
-            "news": stats[key]["news"],
-            "self_report": stats[key]["self_report"]
-        })
+def _getStatsColumns(query: IncidentQuery) -> StatsColumns:
+    rollups = queryRollups(query.start.isoformat(), query.end.isoformat())
+    if query.state != "":
+        rollups = [rollup for rollup in rollups if rollup["incident_location"] == query.state]
+    return StatsColumns.from_rollups(rollups, query.type, query.self_report_status)
+
+
+def getStatsColumns(start: datetime, end: datetime, state="", type="", self_report_status="") -> StatsColumns:
+    try:
+        query = statsQuery(normalizeQuery(start, end, state, type, self_report_status))
+    except ValueError:
+        return StatsColumns.from_rollups([])
+    return _getStatsColumns(query)
 
-    return ret
+
+# Query incidents within the given dates and state
+# Return [ { key: date, incident_location: state, news: count, self_report: count } ]
+def getStats(start: datetime, end: datetime, state="", type="", self_report_status=""):
+    return getStatsColumns(start, end, state, type, self_report_status).daily_by_state()
 
 
 def insertUserReport(user_report, to_flush_cache=True):
@@ -243,11 +425,12 @@ def insertUserReport(user_report, to_flush_cache=True):
     new_user_report.publish_status = (
         user_report["publish_status"] if "publish_status" in user_report else {}
     )
+    new_user_report.publish_pending = pendingTargets(new_user_report.incident_time, new_user_report.publish_status)
 
-    user_report_id = new_user_report.upsert().id
+    user_report_id, scopes = _upsertWithRollups(new_user_report)
     if user_report_id:
         if to_flush_cache:
-            flush_cache()
+            flush_cache(scopes or None)
         return user_report_id
     else:
         raise SystemError(
@@ -255,29 +438,20 @@ def insertUserReport(user_report, to_flush_cache=True):
         )
 
 def updateUserReport(user_report):
-    # Initialize Firestore client
-    db = firestore.Client()
-
-    def get_user_report_by_report_id(report_id):
+    @fireo.transactional
+    def update_user_report(transaction, report_id, updates):
         # Query for the document with the specified report_id
-        doc_ref = db.collection('incident').document(report_id)
-        doc = doc_ref.get()
-        # Iterate over the query results and return the first match
-        if doc.exists:
-            return doc.id, doc.to_dict()  # Return both the document ID and its data
-        # If no match found, return None
-        return None, None
+        user_report_ref = _incidentRef(report_id)
+        doc = user_report_ref.get(transaction=transaction)
+        if not doc.exists:
+            return False
+        existing_report = doc.to_dict()
+        if updates:
+            transaction.update(user_report_ref, updates)
+            updateRollups(transaction, existing_report, {**existing_report, **updates})
+        return True
 
     try:
-        # Get the document ID and the user report data
-        doc_id, existing_report = get_user_report_by_report_id(user_report["report_id"])
-
-        if doc_id is None:
-            return {"error": "Report ID not found", "report_id": user_report["report_id"]}, 404  # Return an error if the report_id does not exist
-
-        # Reference to the specific document to update
-        user_report_ref = db.collection('incident').document(doc_id)
-
         # Update the document with the new details
         updates = {}
         if user_report.get("contact_name"):
@@ -289,8 +463,8 @@ def updateUserReport(user_report):
         if user_report.get("status"):
             updates['status'] = user_report["status"]
 
-        if updates:
-            user_report_ref.update(updates)
+        if not update_user_report(fireo.transaction(), user_report["report_id"], updates):
+            return {"error": "Report ID not found", "report_id": user_report["report_id"]}, 404  # Return an error if the report_id does not exist
 
         # Return the report_id in the response
         return {'report_id': user_report["report_id"]}, 200
@@ -316,18 +490,19 @@ def getAllIncidents(params, user_role):
     if validation_error:
         return validation_error
     
-    # Your existing logic to fetch incidents...
-    incidents = []  # Replace with actual fetching logic
-
-    return {
-        "page_info": {
-            "start_row": 0,
-            "page_size": 10,
-            "total_records": len(incidents),
-            "next_page_token": None
-        },
-        "incidents": incidents
-    }
+    page = getIncidentsPage(
+        dateparser.parse(params.get("start", "2022-11-01")),
+        dateparser.parse(params.get("end", datetime.now().strftime("%Y-%m-%d"))),
+        params.get("state", ""),
+        params.get("type", "both"),
+        params.get("self_report_status", ""),
+        params.get("start_row", ""),
+        params.get("page_size", "10"),
+        params.get("page_token", ""),
+    )
+    if "error" in page:
+        return page, 400
+    return page
     
 def get_incident_by_id(report_id):
     try:
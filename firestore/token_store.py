@@ -0,0 +1,270 @@
+import atexit
+import hashlib
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+
+from cachetools import LRUCache
+from fireo.database import db
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP
+
+from clients import get_client, register_client
+import firestore.tokens as tokens_v1
+import firestore.tokens_v2 as tokens_v2
+import firestore.tokens_v3 as tokens_v3
+import firestore.tokens_v3_0 as tokens_v3_0
+from firestore.write_batches import writeInBatches
+
+# Device push token stores, all behind one interface so the storage design can be
+# switched with TOKEN_STORE (and compared with benchmarks/token_store.py):
+#   document        one document per device (firestore/tokens.py), the default
+#   hash_shard      1000 hash shards with a device -> token map (firestore/tokens_v2.py)
+#   array_shard_tx  shards of parallel device/token arrays with an avail counter,
+#                   written in transactions (firestore/tokens_v3.py)
+#   array_shard     the same without transactions (firestore/tokens_v3_0.py)
+
+
+class TokenStore(ABC):
+    name = None
+
+    @abstractmethod
+    def add_token(self, device_id, token):
+        pass
+
+    def add_tokens(self, tokens: dict):
+        """Register many {device_id: token} at once"""
+        for device_id, token in tokens.items():
+            self.add_token(device_id, token)
+
+    @abstractmethod
+    def delete_tokens(self, device_ids):
+        pass
+
+    @abstractmethod
+    def scan(self):
+        """Yield (device_id, token) of every registered device"""
+
+    def changed_since(self, since):
+        """(device_id, token) written at or after since, and the newest write time seen;
+        None when the design cannot tell, which makes snapshots rescan"""
+        return None
+
+    def _documents(self, model):
+        return db.conn.collection(model.collection_name).stream()
+
+
+class DocumentTokenStore(TokenStore):
+    name = "document"
+
+    def add_token(self, device_id, token):
+        return tokens_v1.add_token(device_id, token)
+
+    def add_tokens(self, tokens: dict):
+        collection = db.conn.collection(tokens_v1.Token.collection_name)
+        writeInBatches(tokens.items(), lambda batch, item: batch.set(
+            collection.document(item[0]), {"token": item[1], "updated_on": SERVER_TIMESTAMP}
+        ))
+
+    def delete_tokens(self, device_ids):
+        return tokens_v1.delete_tokens(device_ids)
+
+    def scan(self):
+        for doc in self._documents(tokens_v1.Token):
+            token = doc.to_dict().get("token")
+            if token:
+                yield doc.id, token
+
+    def changed_since(self, since):
+        query = db.conn.collection(tokens_v1.Token.collection_name)
+        if since is not None:
+            query = query.where("updated_on", ">=", since)
+        changed, newest = [], since
+        for doc in query.stream():
+            data = doc.to_dict()
+            if data.get("token"):
+                changed.append((doc.id, data["token"]))
+            if data.get("updated_on") and (newest is None or data["updated_on"] > newest):
+                newest = data["updated_on"]
+        return changed, newest
+
+
+class HashShardTokenStore(TokenStore):
+    name = "hash_shard"
+
+    def add_token(self, device_id, token):
+        return tokens_v2.add_token(device_id, token)
+
+    def delete_tokens(self, device_ids):
+        for device_id in device_ids:
+            tokens_v2.delete_token(device_id)
+        return len(device_ids)
+
+    def scan(self):
+        for doc in self._documents(tokens_v2.Token):
+            yield from (doc.to_dict().get("tokens") or {}).items()
+
+
+class ArrayShardTokenStore(TokenStore):
+    def __init__(self, transactional=True):
+        self.name = "array_shard_tx" if transactional else "array_shard"
+        self._add_token = tokens_v3.add_token if transactional else tokens_v3_0.add_token
+
+    def add_token(self, device_id, token):
+        return self._add_token(device_id, token)
+
+    def delete_tokens(self, device_ids):
+        # tokens_v3 has no delete; both designs share the document layout
+        for device_id in device_ids:
+            tokens_v3_0.delete_token(device_id)
+        return len(device_ids)
+
+    def scan(self):
+        for doc in self._documents(tokens_v3.Token):
+            data = doc.to_dict()
+            yield from zip(data.get("devices") or [], data.get("tokens") or [])
+
+
+TOKEN_STORES = {
+    "document": DocumentTokenStore,
+    "hash_shard": HashShardTokenStore,
+    "array_shard_tx": lambda: ArrayShardTokenStore(transactional=True),
+    "array_shard": lambda: ArrayShardTokenStore(transactional=False),
+}
+
+
+class TokenSnapshot:
+    """In-memory device_id -> token map of a TokenStore, for notification fan-out.
+
+    refresh() only reads the devices written since the previous refresh when the store
+    supports it, and rescans everything every full_refresh_interval seconds to drop devices
+    deleted by other instances. Deletions made through delete_tokens() apply immediately.
+    """
+
+    def __init__(self, store: TokenStore, full_refresh_interval=3600):
+        self.store = store
+        self._full_refresh_interval = full_refresh_interval
+        self._tokens = {}
+        self._watermark = None
+        self._last_full_refresh = None
+        self._lock = threading.Lock()
+
+    def _full_refresh(self):
+        changes = self.store.changed_since(None)
+        if changes is None:
+            tokens, watermark = dict(self.store.scan()), None
+        else:
+            tokens, watermark = dict(changes[0]), changes[1]
+        with self._lock:
+            self._tokens, self._watermark = tokens, watermark
+            self._last_full_refresh = time.monotonic()
+
+    def refresh(self):
+        stale = self._last_full_refresh is None or \
+            time.monotonic() - self._last_full_refresh > self._full_refresh_interval
+        changes = None if stale or self._watermark is None else self.store.changed_since(self._watermark)
+        if changes is None:
+            self._full_refresh()
+            return
+        changed, watermark = changes
+        with self._lock:
+            tokens = dict(self._tokens)  # copy-on-write, readers keep their own dict
+            tokens.update(changed)
+            self._tokens, self._watermark = tokens, watermark
+
+    def tokens(self) -> dict:
+        self.refresh()
+        return self._tokens
+
+    def delete_tokens(self, device_ids):
+        device_ids = set(device_ids)
+        deleted = self.store.delete_tokens(list(device_ids))
+        with self._lock:
+            self._tokens = {d: t for d, t in self._tokens.items() if d not in device_ids}
+        return deleted
+
+
+class CoalescingTokenWriter:
+    """Write-behind buffer for device token registrations.
+
+    A registration whose token is the one this instance last wrote for the device is
+    dropped. Real changes are buffered (the latest token per device wins) and written with
+    TokenStore.add_tokens every flush_interval seconds, or as soon as max_batch devices are
+    waiting. Anything still buffered is flushed at interpreter exit.
+    """
+
+    def __init__(self, store: TokenStore, flush_interval=0.3, max_batch=200, seen_size=100000):
+        self.store = store
+        self._flush_interval = flush_interval
+        self._max_batch = max_batch
+        self._seen = LRUCache(maxsize=seen_size)  # device_id : digest of the token last written
+        self._pending = {}  # device_id : token
+        self._flush_lock = threading.Lock()  # one flush at a time, in registration order
+        self._wakeup = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="token-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode("utf-8")).digest()[:16]
+
+    def register(self, device_id, token) -> bool:
+        """Queue the registration, return False when it does not change anything"""
+        with self._wakeup:
+            if self._pending.get(device_id, None) == token or \
+                    (device_id not in self._pending and self._seen.get(device_id) == self._digest(token)):
+                return False
+            self._pending[device_id] = token
+            if len(self._pending) >= self._max_batch:
+                self._wakeup.notify()
+        return True
+
+    def flush(self):
+        with self._flush_lock:
+            with self._wakeup:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            try:
+                self.store.add_tokens(batch)
+            except Exception as e:
+                print("Failed to write {} token registration(s): {}".format(len(batch), e))
+                with self._wakeup:
+                    # retry with the next flush, unless the device registered again meanwhile
+                    for device_id, token in batch.items():
+                        self._pending.setdefault(device_id, token)
+                return 0
+            with self._wakeup:
+                for device_id, token in batch.items():
+                    self._seen[device_id] = self._digest(token)
+            return len(batch)
+
+    def _run(self):
+        while not self._closed:
+            with self._wakeup:
+                if len(self._pending) < self._max_batch:
+                    self._wakeup.wait(self._flush_interval)
+            self.flush()
+
+    def close(self):
+        self._closed = True
+        self.flush()
+
+
+register_client("token_store", lambda: TOKEN_STORES[os.getenv("TOKEN_STORE", "document")]())
+register_client("token_snapshot", lambda: TokenSnapshot(get_client("token_store")))
+register_client("token_writer", lambda: CoalescingTokenWriter(get_client("token_store")))
+
+
+def get_token_store() -> TokenStore:
+    return get_client("token_store")
+
+
+def get_token_snapshot() -> TokenSnapshot:
+    return get_client("token_snapshot")
+
+
+def get_token_writer() -> CoalescingTokenWriter:
+    return get_client("token_writer")
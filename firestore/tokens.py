@@ -1,17 +1,27 @@
+from fireo.database import db
 from fireo.models import Model
 from fireo.fields import IDField, TextField, DateTime
 from datetime import datetime, timedelta
 
+from firestore.write_batches import writeInBatches
+
 
 class Token(Model):
     id = IDField(required=True)
     token = TextField(required=True)
+    updated_on = DateTime(auto=True)  # set on every upsert, read by incremental token snapshots
 
 
 def delete_token(token_id):
     return Token.collection.delete("token/" + token_id)
 
 
+def delete_tokens(token_ids):
+    # delete many tokens with batched writes instead of one request per token
+    collection = db.conn.collection(Token.collection_name)
+    return writeInBatches(token_ids, lambda batch, token_id: batch.delete(collection.document(token_id)))
+
+
 def add_token(deviceID, token):
     print("New Device:", deviceID)
     print("New Token:", token)
@@ -0,0 +1,23 @@
+from fireo.database import db
+
+WRITE_BATCH_SIZE = 500  # Firestore limit of writes per batch
+
+
+def writeInBatches(items, write, batch_size=WRITE_BATCH_SIZE):
+    """Call write(batch, item) for every item, committing a WriteBatch every batch_size items.
+
+    write must add exactly one write to the batch. Items are consumed lazily, so a
+    generator is fine; return the number of items written.
+    """
+    batch, pending, written = db.conn.batch(), 0, 0
+    for item in items:
+        write(batch, item)
+        pending += 1
+        if pending == batch_size:
+            batch.commit()
+            written += pending
+            batch, pending = db.conn.batch(), 0
+    if pending:
+        batch.commit()
+        written += pending
+    return written
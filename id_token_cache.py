@@ -0,0 +1,53 @@
+import hashlib
+import re
+import threading
+import time
+
+import google.oauth2.id_token
+from cachetools import LRUCache
+from google.auth.transport import requests
+
+# Verified Firebase ID token claims, keyed by the sha256 of the token and kept until the
+# token's exp. Every authenticated admin call used to redo the RSA signature check.
+_CLAIMS_CACHE = LRUCache(maxsize=1024)
+_CLAIMS_LOCK = threading.Lock()
+_MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+class CachingCertsRequest:
+    """google.auth transport Request that caches GET responses (the signing certs) per Cache-Control max-age"""
+
+    def __init__(self, request=None):
+        self._request = request or requests.Request()
+        self._responses = {}  # url : (expires_at, response)
+        self._lock = threading.Lock()
+
+    def __call__(self, url, method="GET", **kwargs):
+        if method != "GET":
+            return self._request(url, method=method, **kwargs)
+        with self._lock:
+            cached = self._responses.get(url)
+        if cached and cached[0] > time.time():
+            return cached[1]
+        response = self._request(url, method=method, **kwargs)
+        max_age = _MAX_AGE.search(response.headers.get("Cache-Control", "")) if response.status == 200 else None
+        if max_age:
+            with self._lock:
+                self._responses[url] = (time.time() + int(max_age.group(1)), response)
+        return response
+
+
+_certs_request = CachingCertsRequest()
+
+
+def verify_firebase_token(id_token) -> dict:
+    """Claims of a Firebase ID token, verified once per token; raise ValueError if it is invalid"""
+    digest = hashlib.sha256(id_token.encode("utf-8")).hexdigest()
+    with _CLAIMS_LOCK:
+        claims = _CLAIMS_CACHE.get(digest)
+    if claims is not None and claims.get("exp", 0) > time.time():
+        return claims
+    claims = google.oauth2.id_token.verify_firebase_token(id_token, _certs_request)
+    with _CLAIMS_LOCK:
+        _CLAIMS_CACHE[digest] = claims
+    return claims
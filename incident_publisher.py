@@ -1,51 +1,130 @@
-from datetime import datetime
-from social_media_publishers.linkedin import LinkedIn
-from social_media_publishers.twitter_v2 import TwitterV2
-from social_media_publishers.notification import PushNotification
+import time
+
+from fireo.database import db
+from fireo.queries.query_wrapper import ModelWrapper
+from google.cloud.firestore_v1 import ArrayRemove
+from google.cloud.firestore_v1.field_path import FieldPath
+
 from firestore.incidents import Incident
+from firestore.incident_publish_status import (PUBLISH_SINCE, PUBLISH_TARGETS, getPublishWatermark, pendingTargets,
+                                               setPublishWatermark)
+from firestore.write_batches import WRITE_BATCH_SIZE, writeInBatches
+
+# Publish incidents to the targets they have not been published to yet.
+# Every incident carries publish_pending, the targets it still has to be published to (set
+# when it is written). A run only reads incidents pending for a target, at most
+# PUBLISH_BATCH_SIZE of them, publishes them concurrently (see PublishingExecutor) and
+# removes the targets from publish_pending together with setting publish_status.<target> as
+# the publishes complete (every SAVE_BATCH_SIZE results or SAVE_INTERVAL seconds), so a run
+# that crashes or times out resumes with what is left and only republishes the last few.
+# Incidents written before publish_pending existed are marked by a bounded scan that
+# resumes from a durable watermark.
+SCAN_BATCH_SIZE = WRITE_BATCH_SIZE - 1  # plus the watermark, within one batch
+PUBLISH_BATCH_SIZE = 100
+SAVE_BATCH_SIZE = 10
+SAVE_INTERVAL = 5  # seconds
+PUBLISH_WORKERS = 8
+# target : (publishes per second, burst)
+PUBLISH_RATE_LIMITS = {
+    "twitter": (0.2, 1),
+    "linkedin": (0.2, 1),
+    "notification": (1, 2),  # every publish is a fan-out to all device tokens
+}
+
+
+def _incidents():
+    return db.conn.collection(Incident.collection_name)
+
+
+def mark_unscanned_incidents():
+    # return the number of incidents scanned after the watermark
+    query = _incidents().order_by("incident_time")
+    watermark = getPublishWatermark()
+    if watermark is None:
+        query = query.where("incident_time", ">=", PUBLISH_SINCE)
+    else:
+        incident_time, incident_id = watermark
+        last_scanned = _incidents().document(incident_id).get()
+        query = query.start_after(last_scanned) if last_scanned.exists else query.where("incident_time", ">", incident_time)
+
+    batch = db.conn.batch()
+    scanned = None
+    count = 0
+    for doc in query.limit(SCAN_BATCH_SIZE).stream():
+        incident = doc.to_dict()
+        if "publish_pending" not in incident:
+            batch.update(doc.reference, {
+                "publish_pending": pendingTargets(incident.get("incident_time"), incident.get("publish_status"))
+            })
+        scanned = doc
+        count += 1
+    if scanned is not None:
+        setPublishWatermark(batch, scanned.get("incident_time"), scanned.id)
+        batch.commit()
+    return count
 
-# check all incidents in database, and publish those have not yet been published yet
-# update incident.publish_status when done
+
+def _save_publish_status(results):
+    # partial updates of publish_status.<target> (and publish_pending), in as few batches as possible
+    def update(batch, result):
+        target, incident_id, publish_time = result
+        batch.update(_incidents().document(incident_id), {
+            FieldPath("publish_status", target).to_api_repr(): publish_time,
+            "publish_pending": ArrayRemove([target]),
+        })
+
+    writeInBatches(results, update)
 
 
 def publish_incidents():
-    success = 0
-    failed = 0
+    # Publishers pull in the Expo SDK, Secret Manager and OAuth clients, only load them for the cron job
+    from social_media_publishers.executor import PublishingExecutor
+    from social_media_publishers.linkedin import LinkedIn
+    from social_media_publishers.twitter_v2 import TwitterV2
+    from social_media_publishers.notification import PushNotification
+
     PUBLISHERS = {
         #"twitter": TwitterV2(),
         #"linkedin": LinkedIn(),
         "notification": PushNotification(),
     }
-    incidents = (
-        Incident.collection.filter("incident_time", ">=", datetime(2024, 1, 1))
-        .order("incident_time")
-        .fetch()
+    scanned = mark_unscanned_incidents()
+    print("Scanned {} incident(s) for pending publish targets".format(scanned))
+
+    jobs = []
+    for target in PUBLISH_TARGETS:
+        pending = _incidents().where("publish_pending", "array_contains", target).limit(PUBLISH_BATCH_SIZE)
+        jobs.extend((target, ModelWrapper.from_query_result(Incident(), doc)) for doc in pending.stream())
+
+    # every target runs concurrently, each within its own rate limit
+    executor = PublishingExecutor(
+        {target: PUBLISHERS[target] for target in PUBLISH_TARGETS},
+        PUBLISH_RATE_LIMITS,
+        max_workers=PUBLISH_WORKERS,
     )
-    for incident in incidents:
-        for target, publisher in PUBLISHERS.items():
-            if not incident.publish_status:
-                incident.publish_status = {}
-            if target in incident.publish_status and incident.publish_status[target]:
-                continue  # already published to the target
-            print(
-                "Publishing incident to {} using publisher {}".format(target, publisher)
-            )
-            publish_time = publisher.publish(incident)
-            if not publish_time:
-                print("Failed to publish to ", target)
-                failed += 1
-                continue
+    unsaved = []
+    saved = 0
+    failed = 0
+    last_save = time.monotonic()
+    for target, incident, publish_time in executor.run(jobs):
+        if not publish_time:
+            print("Failed to publish to ", target, incident.id)
+            failed += 1  # still pending, retried by the next run
+        else:
             print("Successfully published to ", target, " at ", publish_time)
-            incident.publish_status[target] = publish_time
-            # Uncomment me once the publishers are working
+            unsaved.append((target, incident.id, publish_time))
+        if unsaved and (len(unsaved) >= SAVE_BATCH_SIZE or time.monotonic() - last_save >= SAVE_INTERVAL):
             try:
-                incident.save()
-                print("Successfully saved publish_status: " + incident.to_dict()["id"])
+                _save_publish_status(unsaved)
+                saved += len(unsaved)
+                unsaved = []
             except Exception as e:
-                print(
-                    "An error occurred:",
-                    e,
-                    incident.to_dict()["id"],
-                )
-            success += 1
-    print("success:", success, " failed:", failed)
+                # kept for the next save; the last one below raises if it still fails
+                print("Failed to save publish_status, retrying with the next results:", e)
+            last_save = time.monotonic()
+    if unsaved:
+        _save_publish_status(unsaved)
+        saved += len(unsaved)
+    print("Successfully saved publish_status of {} publish(es)".format(saved))
+    print("success:", saved, " failed:", failed)
+    return {"scanned": scanned, "success": saved, "failed": failed}
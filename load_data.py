@@ -1,72 +1,25 @@
+import argparse
 import traceback
-from firestore.incidents import Incident, insertIncident
+from collections import deque
+from firestore.cachemanager import flush_cache
+from firestore.incident_rollups import rollupCell
+from firestore.incidents import createIncidents, newIncident
+from firestore.write_batches import WRITE_BATCH_SIZE
+from location_resolver import get_location_resolver
+import dateparser
+import hashlib
 import json
 import datetime
-import re
+import os
 import csv
+import concurrent.futures
+
+try:
+    import ijson
+except ImportError:  # optional, without it JSON files are loaded whole
+    ijson = None
+
 
-STATES = {
-    "Alabama" : "AL",
-    "Alaska" : "AK",
-    "Arizona" : "AZ",
-    "Arkansas" : "AR",
-    "California" : "CA",
-    "Colorado" : "CO",
-    "Connecticut" : "CT",
-    "Delaware" : "DE",
-    "Florida" : "FL",
-    "Georgia" : "GA",
-    "Hawaii" : "HI",
-    "Idaho" : "ID",
-    "Illinois" : "IL",
-    "Indiana" : "IN",
-    "Iowa" : "IA",
-    "Kansas" : "KS",
-    "Kentucky" : "KY",
-    "Louisiana" : "LA",
-    "Maine" : "ME",
-    "Maryland" : "MD",
-    "Massachusetts" : "MA",
-    "Michigan" : "MI",
-    "Minnesota" : "MN",
-    "Mississippi" : "MS",
-    "Missouri" : "MO",
-    "Montana" : "MT",
-    "Nebraska" : "NE",
-    "Nevada" : "NV",
-    "New Hampshire" : "NH",
-    "New Jersey" : "NJ",
-    "New Mexico" : "NM",
-    "New York" : "NY",
-    "North Carolina" : "NC",
-    "North Dakota" : "ND",
-    "Ohio" : "OH",
-    "Oklahoma" : "OK",
-    "Oregon" : "OR",
-    "Pennsylvania" : "PA",
-    "Rhode Island" : "RI",
-    "South Carolina" : "SC",
-    "South Dakota" : "SD",
-    "Tennessee" : "TN",
-    "Texas" : "TX",
-    "Utah" : "UT",
-    "Vermont" : "VT",
-    "Virginia" : "VA",
-    "Washington" : "WA",
-    "West Virginia" : "WV",
-    "Wisconsin" : "WI",
-    "Wyoming" : "WY"
-}
-ZIP_TO_STATE = dict()
-
-def load_zip_to_state():
-    ZIP_TO_STATE.clear()
-    with open('uszips.csv', newline='') as csvfile:
-        csvreader = csv.reader(csvfile, delimiter=',', quotechar='"')
-        for row in csvreader:
-            if row[0] == 'zip' or not row[0]:
-                continue
-            ZIP_TO_STATE[row[0]] = row[4]
 def get_date(record):
     for pattern in ["%B, %Y", '%m/%d/%Y', '%m/%d/%y']:
         try:
@@ -120,9 +73,6 @@ class IncidentBuffer:
         self.incidents=[]
 
     def get_state(self, incident):
-        if len(ZIP_TO_STATE) == 0:
-                load_zip_to_state()
-                print("Zip to state:{}".format(ZIP_TO_STATE.values))
         # Location_City_State_ : Garden Ln & Los Gatos Blvd, Los Gatos, CA 95032
         #                           Sunset District, San Francisco, CA
         #                           Outer Sunset, San Francisco, CA
@@ -132,20 +82,24 @@ class IncidentBuffer:
             if state != "":
                 return state
 
+        resolver = get_location_resolver()
         if incident.get("Location_City_State_"):
-            m = re.search('(\d{5})', incident['Location_City_State_'])
-            if m:
-                for group in m.groups():
-                    if group in ZIP_TO_STATE:
-                        return ZIP_TO_STATE[group] 
-            for str in incident['Location_City_State_'].split(','):
-              str = str.strip()
-              if str in ZIP_TO_STATE.values():
-                  return str
-
-        return ""
-        
+            state = resolver.state_of_address(incident['Location_City_State_'])
+            if state:
+                return state
+
+        try:
+            latitude, longitude = float(incident["Latitude"]), float(incident["Longitude"])
+        except (KeyError, TypeError, ValueError):
+            return ""
+        return resolver.state_at(latitude, longitude) or ""
+
     def add(self, record):
+        incident = self.to_incident(record)
+        if incident:
+            self.incidents.append(incident)
+
+    def to_incident(self, record):
         try:
             # location = geolocator.reverse("{},{}".format(record.get("Latitude"),record.get("Longitude")))
             # (state, zip, country) = location.address.split(",")[-3:]
@@ -156,9 +110,9 @@ class IncidentBuffer:
             state = self.get_state(record)
             if state == "":
                 print("Failed to find state:{}".format(record))
-                return
+                return None
 
-            self.incidents.append(dict(
+            return dict(
                     incident_time=get_date(record),
                     created_on=datetime.datetime.now(),
                     incident_location=state,
@@ -166,11 +120,12 @@ class IncidentBuffer:
                     url=record.get("News_Source"),
                     incident_source="racismiscontagious",
                     title=record.get("Summary")               
-                ))
+                )
         except Exception as e:
             print(e)
             print (traceback.format_exc())
             print(record)
+            return None
 
     def get_incidents(self):
         return self.incidents
@@ -185,17 +140,43 @@ class Counter:
     def get_count(self):
         return self.count
 
-def traverse(json, buffer):
+def walk_attributes(json):
+    # every "attributes" value nested in json
     if isinstance(json, list):
         for value in json:
-            traverse(value, buffer)
+            yield from walk_attributes(value)
     else:
         if type(json) is dict:
             for key in json:
                 if key == "attributes":
-                    buffer.add(json[key])
+                    yield json[key]
                     continue
-                traverse(json[key], buffer)
+                yield from walk_attributes(json[key])
+
+def traverse(json, buffer):
+    for record in walk_attributes(json):
+        buffer.add(record)
+
+def iter_attributes(f):
+    # yield every "attributes" object of the JSON file like walk_attributes, parsing it incrementally
+    if ijson is None:
+        yield from walk_attributes(json.load(f))
+        return
+    events = ijson.parse(f)
+    for _, event, value in events:
+        if event != "map_key" or value != "attributes":
+            continue
+        builder = ijson.ObjectBuilder()
+        depth = 0
+        for _, event, value in events:
+            builder.event(event, value)
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+            if depth == 0:
+                break
+        yield builder.value
 
 COLUMNS = ["incident_time", "created_on", "incident_location",  "abstract", "url", "incident_source", "title"]
 def write_to_csv(incidents):
@@ -213,27 +194,144 @@ def write_to_csv(incidents):
             id += 1
 
 def traverse_file(fileName):
-    load_zip_to_state()
-    with open(fileName) as f:
+    count = 0
+    with open(fileName, 'rb') as f:
         buffer = IncidentBuffer()
-        traverse(json.load(f), buffer)
-        print("Count:{}".format(len(buffer.get_incidents())))
-        # for incident in buffer.get_incidents():
-        #     insertIncident(incident=incident)
-        write_to_csv(buffer.get_incidents())
-        return len(buffer.get_incidents())
-
-def load_from_csv(fileName):
-    HEADER = ["id", "incident_time", "created_on", "incident_location",  "abstract", "url", "incident_source", "title"]
+        def incidents():
+            nonlocal count
+            for record in iter_attributes(f):
+                incident = buffer.to_incident(record)
+                if incident:
+                    count += 1
+                    yield incident
+        write_to_csv(incidents())
+    print("Count:{}".format(count))
+    return count
+
+# Bulk load of tab separated incident files (the HEADER columns):
+#   python load_data.py incidents.tsv [--workers 4] [--restart]
+# Rows are read and validated one at a time, and written with createIncidents in batches of
+# up to WRITE_BATCH_SIZE writes (documents plus rollup cells) on a few workers. Incident ids
+# are derived from the content, and the number of rows fully written is kept in a checkpoint
+# file, so an interrupted load resumes where it stopped without duplicating incidents.
+# The caches are flushed once, at the end.
+HEADER = ["id", "incident_time", "created_on", "incident_location",  "abstract", "url", "incident_source", "title"]
+LOAD_WORKERS = 4
+CHECKPOINT_SUFFIX = ".checkpoint"
+
+def read_csv_rows(fileName, skip_rows=0):
+    # yield (row number, incident dict) after the first skip_rows rows
     with open(fileName, newline='') as csvfile:
-        for row in list(csv.reader(csvfile, delimiter='\t')):
-            incident=dict(zip(HEADER, row))
-            if incident["incident_time"] == "incident_time":
+        for row_number, row in enumerate(csv.reader(csvfile, delimiter='\t'), 1):
+            if row_number <= skip_rows:
+                continue
+            incident = dict(zip(HEADER, row))
+            if incident.get("incident_time") == "incident_time":
                 continue # skip header
+            yield row_number, incident
+
+def validate_incident(incident):
+    # incident dict ready for newIncident, raise ValueError when the row is unusable
+    for field in ["incident_time", "incident_location", "abstract"]:
+        if not (incident.get(field) or "").strip():
+            raise ValueError("missing " + field)
+    incident_time = dateparser.parse(incident["incident_time"])
+    if incident_time is None:
+        raise ValueError("invalid incident_time " + incident["incident_time"])
+    validated = dict(
+        incident_time=incident_time,
+        incident_location=incident["incident_location"].strip(),
+        abstract=incident["abstract"],
+        url=incident.get("url") or None,
+        incident_source=incident.get("incident_source") or None,
+        created_by=None,
+        title=incident.get("title") or None,
+    )
+    # the same incident always gets the same id, so reloading a file does not duplicate it
+    key = "\t".join([validated["incident_source"] or "", validated["url"] or "", validated["title"] or "",
+                     validated["abstract"], incident_time.isoformat()])
+    validated["id"] = hashlib.sha256(key.encode("utf-8")).hexdigest()[:20]
+    return validated
+
+def validated_incidents(rows):
+    # yield (row number, Incident) of the valid rows
+    for row_number, incident in rows:
+        try:
+            yield row_number, newIncident(validate_incident(incident))
+        except ValueError as e:
+            print("Skipping row {}: {}".format(row_number, e))
+
+def incident_batches(incidents):
+    # group (row number, Incident) so that the documents and their rollup cells fit in one batch.
+    # Repeated rows have the same id: only the first is written, otherwise batches in flight
+    # together would both find the id missing and count it twice in the rollups
+    batch, cells, seen = [], set(), set()
+    for row_number, incident in incidents:
+        if incident.id in seen:
+            print("Skipping row {}: duplicate of incident {}".format(row_number, incident.id))
+            continue
+        seen.add(incident.id)
+        cell = rollupCell(incident.to_dict())
+        if batch and len(batch) + len(cells | {cell} - {None}) + 1 > WRITE_BATCH_SIZE:
+            yield batch
+            batch, cells = [], set()
+        batch.append((row_number, incident))
+        if cell:
+            cells.add(cell)
+    if batch:
+        yield batch
+
+def read_checkpoint(checkpoint):
+    try:
+        with open(checkpoint) as f:
+            return json.load(f)["rows"]
+    except FileNotFoundError:
+        return 0
+
+def write_checkpoint(checkpoint, rows):
+    with open(checkpoint + ".tmp", "w") as f:
+        json.dump({"rows": rows}, f)
+    os.replace(checkpoint + ".tmp", checkpoint)
+
+def bulk_load(rows, checkpoint, workers=LOAD_WORKERS):
+    # write the rows with createIncidents, return the number of incidents created
+    created = 0
+    in_flight = deque()  # (last row number, future), in row order
+    def wait_oldest():
+        nonlocal created
+        row_number, future = in_flight.popleft()
+        created += len(future.result())
+        # every row up to row_number is written: the batches before it completed first
+        write_checkpoint(checkpoint, row_number)
+        print("Loaded rows up to {}, {} incidents created".format(row_number, created))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for batch in incident_batches(validated_incidents(rows)):
+                if len(in_flight) >= 2 * workers:
+                    wait_oldest()
+                in_flight.append((batch[-1][0], pool.submit(createIncidents, [incident for _, incident in batch])))
+            while in_flight:
+                wait_oldest()
+    finally:
+        if created:
+            flush_cache()
+    return created
+
+def load_from_csv(fileName, workers=LOAD_WORKERS, restart=False):
+    checkpoint = fileName + CHECKPOINT_SUFFIX
+    skip_rows = 0 if restart else read_checkpoint(checkpoint)
+    if skip_rows:
+        print("Resuming after row {}".format(skip_rows))
+    created = bulk_load(read_csv_rows(fileName, skip_rows), checkpoint, workers)
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    print("Created {} incidents".format(created))
+    return created
 
-            del incident["id"]
-            incident["created_on"] = datetime.datetime.strftime(datetime.datetime.now(), "%Y-%m-%d %H:%M:%S")
-            print(incident)
-            incident["incident_time"] =incident["incident_time"]
-            print(incident)
-            insertIncident(incident)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file", help="tab separated incidents with the HEADER columns")
+    parser.add_argument("--workers", type=int, default=LOAD_WORKERS)
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint of a previous run")
+    args = parser.parse_args()
+    load_from_csv(args.file, args.workers, args.restart)
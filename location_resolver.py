@@ -0,0 +1,196 @@
+import csv
+import math
+import os
+import re
+
+from clients import get_client, register_client
+
+# Resolve the US state of imported incident records (see load_data.py) from an address
+# ("Garden Ln & Los Gatos Blvd, Los Gatos, CA 95032", "Outer Sunset, San Francisco") or from
+# coordinates. Everything is precomputed into dicts and sets when the resolver is created:
+#   ZIP codes        uszips.csv (zip, lat, lng, city, state_id, ...)
+#   state names      STATES
+#   city names       Top populated cities in the USA.csv, then the cities of uszips.csv that
+#                    only exist in one state
+#   coordinates      a grid of GRID_DEGREES cells over the ZIP and city coordinates, searched
+#                    for the nearest point within MAX_DISTANCE_KM
+
+STATES = {
+    "Alabama" : "AL",
+    "Alaska" : "AK",
+    "Arizona" : "AZ",
+    "Arkansas" : "AR",
+    "California" : "CA",
+    "Colorado" : "CO",
+    "Connecticut" : "CT",
+    "Delaware" : "DE",
+    "Florida" : "FL",
+    "Georgia" : "GA",
+    "Hawaii" : "HI",
+    "Idaho" : "ID",
+    "Illinois" : "IL",
+    "Indiana" : "IN",
+    "Iowa" : "IA",
+    "Kansas" : "KS",
+    "Kentucky" : "KY",
+    "Louisiana" : "LA",
+    "Maine" : "ME",
+    "Maryland" : "MD",
+    "Massachusetts" : "MA",
+    "Michigan" : "MI",
+    "Minnesota" : "MN",
+    "Mississippi" : "MS",
+    "Missouri" : "MO",
+    "Montana" : "MT",
+    "Nebraska" : "NE",
+    "Nevada" : "NV",
+    "New Hampshire" : "NH",
+    "New Jersey" : "NJ",
+    "New Mexico" : "NM",
+    "New York" : "NY",
+    "North Carolina" : "NC",
+    "North Dakota" : "ND",
+    "Ohio" : "OH",
+    "Oklahoma" : "OK",
+    "Oregon" : "OR",
+    "Pennsylvania" : "PA",
+    "Rhode Island" : "RI",
+    "South Carolina" : "SC",
+    "South Dakota" : "SD",
+    "Tennessee" : "TN",
+    "Texas" : "TX",
+    "Utah" : "UT",
+    "Vermont" : "VT",
+    "Virginia" : "VA",
+    "Washington" : "WA",
+    "West Virginia" : "WV",
+    "Wisconsin" : "WI",
+    "Wyoming" : "WY"
+}
+ZIPS_PATH = os.getenv("USZIPS_PATH", "uszips.csv")
+CITIES_PATH = os.getenv("CITIES_PATH", "Top populated cities in the USA.csv")
+GRID_DEGREES = 0.5
+MAX_DISTANCE_KM = 50
+EARTH_RADIUS_KM = 6371.0
+ZIP_PATTERN = re.compile(r"\b(\d{5})(?:-\d{4})?\b")
+
+
+def _distance_km(lat1, lon1, lat2, lon2):
+    # equirectangular approximation, plenty for nearest-point lookups within MAX_DISTANCE_KM
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS_KM * math.hypot(x, y)
+
+
+class LocationResolver:
+    def __init__(self, zips=(), cities=()):
+        """zips are (zip, lat, lon, city, state code), cities are (city, state name, population, lat, lon)"""
+        state_names = {**STATES, "District of Columbia": "DC"}
+        self.state_by_name = {name.lower(): code for name, code in state_names.items()}
+        self.zip_to_state = {}
+        self.city_to_state = {}
+        self._grid = {}  # (lat cell, lon cell) : [(lat, lon, state)]
+
+        zip_city_states = {}  # city : set of states
+        for zip_code, lat, lon, city, state in zips:
+            self.zip_to_state[zip_code] = state
+            if city:
+                zip_city_states.setdefault(city.lower(), set()).add(state)
+            self._add_point(lat, lon, state)
+
+        for city, state_name, population, lat, lon in sorted(cities, key=lambda c: -c[2]):
+            state = self.state_by_name.get(state_name.lower())
+            if not state:
+                continue
+            self.city_to_state.setdefault(city.lower(), state)  # the most populated city of that name wins
+            self._add_point(lat, lon, state)
+        for city, states in zip_city_states.items():
+            if len(states) == 1:
+                self.city_to_state.setdefault(city, next(iter(states)))
+
+        self.state_codes = frozenset(state_names.values()) | frozenset(self.zip_to_state.values())
+
+    @classmethod
+    def load(cls, zips_path=ZIPS_PATH, cities_path=CITIES_PATH):
+        zips = []
+        if os.path.exists(zips_path):
+            with open(zips_path, newline='') as csvfile:
+                for row in csv.reader(csvfile, delimiter=',', quotechar='"'):
+                    if row[0] == 'zip' or not row[0]:
+                        continue
+                    zips.append((row[0], _float(row[1]), _float(row[2]), row[3], row[4]))
+        else:
+            print("ZIP codes not found at {}, resolving without them".format(zips_path))
+        cities = []
+        with open(cities_path, newline='') as csvfile:
+            for row in csv.DictReader(csvfile):
+                cities.append((row["City"], row["State"], int(row["Population"] or 0), _float(row["lat"]), _float(row["lon"])))
+        resolver = cls(zips, cities)
+        print("Location resolver: {} ZIP codes, {} cities, {} grid cells".format(
+            len(resolver.zip_to_state), len(resolver.city_to_state), len(resolver._grid)))
+        return resolver
+
+    def _cell(self, lat, lon):
+        return (math.floor(lat / GRID_DEGREES), math.floor(lon / GRID_DEGREES))
+
+    def _add_point(self, lat, lon, state):
+        if lat is not None and lon is not None:
+            self._grid.setdefault(self._cell(lat, lon), []).append((lat, lon, state))
+
+    def state_of_address(self, address):
+        """State code of a free form address, None when nothing in it is recognized.
+
+        An explicit state code or name wins over a ZIP code, as house numbers look like ZIP
+        codes too ("10099 Research Blvd, Austin, TX 78759").
+        """
+        tokens = [token.strip() for token in address.split(',')]
+        for token in tokens:
+            if token in self.state_codes:
+                return token
+            # "CA 95032"
+            words = token.split()
+            if len(words) == 2 and words[0] in self.state_codes and words[1].isdigit():
+                return words[0]
+        for token in tokens:
+            state = self.state_by_name.get(token.lower())
+            if state:
+                return state
+        # the ZIP code usually ends the address, after any house number
+        for zip_code in reversed(ZIP_PATTERN.findall(address)):
+            state = self.zip_to_state.get(zip_code)
+            if state:
+                return state
+        for token in tokens:
+            state = self.city_to_state.get(token.lower())
+            if state:
+                return state
+        return None
+
+    def state_at(self, lat, lon, max_distance_km=MAX_DISTANCE_KM):
+        """State of the nearest known ZIP code or city within max_distance_km, None if there is none"""
+        lat_cell, lon_cell = self._cell(lat, lon)
+        # a cell spans at least GRID_DEGREES of latitude, and more km of longitude away from the poles
+        lat_rings = math.ceil(max_distance_km / (GRID_DEGREES * 111.0))
+        lon_rings = math.ceil(lat_rings / max(math.cos(math.radians(min(abs(lat), 89.0))), 0.01))
+        best, best_distance = None, max_distance_km
+        for i in range(lat_cell - lat_rings, lat_cell + lat_rings + 1):
+            for j in range(lon_cell - lon_rings, lon_cell + lon_rings + 1):
+                for point_lat, point_lon, state in self._grid.get((i, j), ()):
+                    distance = _distance_km(lat, lon, point_lat, point_lon)
+                    if distance <= best_distance:
+                        best, best_distance = state, distance
+        return best
+
+
+def _float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+register_client("location_resolver", LocationResolver.load)
+
+
+def get_location_resolver() -> LocationResolver:
+    return get_client("location_resolver")
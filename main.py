@@ -12,24 +12,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import calendar
 from datetime import datetime, timedelta, date
 import dateparser
 from logging import error
 from time import time
-from translate import translate_incidents, clean_unused_translation
+from translate import incidents_view
 
-import google.oauth2.id_token
 from flask import Flask, render_template, request, jsonify
 from flask_cors import CORS
-from google.auth.transport import Response, requests
 
 import firestore.admins
 from common import User
-from firestore.incidents import deleteIncident, getIncidents, getStats, insertIncident, insertUserReport, updateUserReport, get_incident_by_id
-from firestore.tokens import add_token
+from firestore.incidents import clearQueryCaches, deleteIncident, getIncidents, getStatsColumns, queryIncidentCube, insertIncident, insertUserReport, updateUserReport, get_incident_by_id
+from firestore.cachemanager import INCIDENT_VIEW_CACHE, cache_stats, cached
+from firestore.incident_query import normalizeQuery, statsQuery
+from firestore.incident_stats import StatsColumns
+from firestore.incident_cube import parseCubeQuery
+from encoded_response import EncodedResponse
+from id_token_cache import verify_firebase_token
+from firestore.token_store import get_token_writer
 import incident_publisher
-from google.cloud.firestore_v1 import SERVER_TIMESTAMP
 
 
 # [END gae_python3_datastore_store_and_fetch_user_times]
@@ -37,7 +39,6 @@ from google.cloud.firestore_v1 import SERVER_TIMESTAMP
 app = Flask(__name__)
 # cors = CORS(app, resources={r"/*": {"origins": "*"}})
 cors = CORS(app)
-firebase_request_adapter = requests.Request()
 
 
 def _check_is_admin(request) -> bool:
@@ -66,9 +67,7 @@ def _get_user(request) -> User:
             raise ValueError("Bearer token expected")
     if id_token:
         try:
-            claims = google.oauth2.id_token.verify_firebase_token(
-                id_token, firebase_request_adapter
-            )
+            claims = verify_firebase_token(id_token)
             return User.from_dict(claims)
         except ValueError as exc:
             print(exc)
@@ -86,12 +85,13 @@ def _getCommonArgs():
     self_report_status = request.args.get("self_report_status", "")
     start_row = request.args.get("start_row", "")
     page_size = request.args.get("page_size", "")
-    return dateparser.parse(start), dateparser.parse(end), state, type, self_report_status, start_row, page_size
+    page_token = request.args.get("page_token", "")
+    return dateparser.parse(start), dateparser.parse(end), state, type, self_report_status, start_row, page_size, page_token
 
 
 @app.route("/")
 def root():
-    start, end, state, type, self_report_status, start_row, page_size = _getCommonArgs()
+    start, end, state, type, self_report_status, start_row, page_size, _ = _getCommonArgs()
     incidents = getIncidents(start, end, state, type, self_report_status, start_row, page_size)
     return render_template(
         "index.html", incidents=incidents, current_user=_get_user(request)
@@ -110,30 +110,27 @@ def get_is_admin():
 
 @app.route("/incidents")
 def get_incidents():
-    start, end, state, type, self_report_status, start_row, page_size = _getCommonArgs()
+    start, end, state, type, self_report_status, start_row, page_size, page_token = _getCommonArgs()
     skip_cache = request.args.get("skip_cache", "false")
     
-    # Only check admin for self-report type when status is not approved
-    if skip_cache.lower() == "true" or (type == "self-report" and self_report_status != "approved"):
+    # Only check admin for self-reports when status is not approved
+    try:
+        query = normalizeQuery(start, end, state, type, self_report_status, start_row, page_size, page_token)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if skip_cache.lower() == "true" or (query.type != "news" and query.self_report_status != "approved"):
         _check_is_admin(request)
-    # Get incidents (this might return an error response instead of a list)
-    incidents = getIncidents(start, end, state, type, self_report_status, start_row, page_size, skip_cache.lower() == "true")
-    
-    # Check if incidents is an error response
-    if isinstance(incidents, dict) and "error" in incidents:
-        return jsonify(incidents), 400
+    if skip_cache.lower() == "true":
+        clearQueryCaches()
+    # Get the cached, language projected page (this might be an error response instead)
+    return _incidents_response(query, _get_lang(request)).to_response(request)
 
-    # Handle potential Sentinel type in the created_on field
-    for incident in incidents:
-        if isinstance(incident, dict) and 'created_on' in incident and incident['created_on'] == SERVER_TIMESTAMP:
-            incident['created_on'] = None
 
-    lang = _get_lang(request)
-    return {
-        "incidents": clean_unused_translation(
-            translate_incidents(incidents, lang), lang
-        )
-    }
+# Encoded once per query and language; evicted with the cached pages of the query
+@cached(cache=INCIDENT_VIEW_CACHE)
+def _incidents_response(query, lang) -> EncodedResponse:
+    view = incidents_view(query, lang)
+    return EncodedResponse(view, 400 if "error" in view else 200)
 
 
 @app.route("/incidents/<id>", methods=["DELETE"])
@@ -160,79 +157,63 @@ def create_incident():
         return jsonify({"error": "Invalid request data or internal server error."}), 500
 
 
-def _aggregate_monthly_total(stats, state=None):
-    monthly_total = {}
-    for daily in stats:
-        # Skip if state is specified and doesn't match
-        if state and daily["incident_location"] != state:
-            continue
-        # Convert YYYY-MM-DD to YYYY-MM
-        str_month = daily["key"][:7]
-        # Store separate counts for news and self-report for frontend needs
-        if str_month not in monthly_total:
-            monthly_total[str_month] = {"news": 0, "self_report": 0}
-        monthly_total[str_month]["news"] += daily["news"]
-        monthly_total[str_month]["self_report"] += daily["self_report"]
-    return monthly_total
-
-
 @app.route("/stats")
 def get_stats():
     # return
     # stats: [{"key": date, "news": count, "self_report": count}] this is daily count filtered by state if needed
     # total: { "location": count } : total per state, not filtered by state
     # insight: { "location": {"news": count, "self_report": count} } : breakdown by type
-    start_date, end_date, state, type, self_report_status, _, _ = _getCommonArgs()
-    str_start = start_date.strftime("%Y-%m-%d")
-    str_end = end_date.strftime("%Y-%m-%d")
-
-    # Use the type parameter from request instead of hardcoding "both"
-    fullmonth_stats = getStats(
-        start_date.replace(day=1),
-        end_date.replace(day=calendar.monthrange(end_date.year, end_date.month)[1]),
-        "",  # Empty state to get all states, this is by design
-        type,  # Use the type filter from the request
-        self_report_status  # Pass through any self_report_status filter
-    )  # [{key(date), incident_location, news, self_report}]
-    monthly_stats = _aggregate_monthly_total(fullmonth_stats, state)  # Pass state here for filtering
-    
-    # Initialize both total and insight dictionaries
-    total = {}
-    insight = {}  # New field for type breakdown
-    
-    # national data is by state and by date, merge all state per date, and calculate state total
-    aggregated = {}
-    for stat in fullmonth_stats:
-        str_date = stat["key"]
-        if str_date < str_start or str_date > str_end:
-            continue
-
-        # Sum news and self_report for total value
-        value = stat["news"] + stat["self_report"]
-        location = stat["incident_location"]
-        
-        # Always include in totals regardless of state filter
-        total[location] = total.get(location, 0) + value
-        
-        # Initialize the insight object for this location if not exists
-        if location not in insight:
-            insight[location] = {"news": 0, "self_report": 0}
-            
-        # Count by type in insight - always include in totals regardless of state filter
-        insight[location]["news"] += stat["news"] 
-        insight[location]["self_report"] += stat["self_report"]
-        
-        # Only include in daily stats if matches state filter
-        if not state or state == location:
-            if str_date not in aggregated:
-                aggregated[str_date] = {"news": 0, "self_report": 0}
-            aggregated[str_date]["news"] += stat["news"]
-            aggregated[str_date]["self_report"] += stat["self_report"]
-
-    # Convert aggregated to the format expected by frontend
-    stats = [{"key": k, "news": v["news"], "self_report": v["self_report"]} for k, v in aggregated.items()]
-
-    return {"stats": stats, "total": total, "monthly_stats": monthly_stats, "insight": insight}
+    # monthly_stats: { "YYYY-MM": {"news": count, "self_report": count} } : whole months, filtered by state
+    start_date, end_date, state, type, self_report_status, _, _, _ = _getCommonArgs()
+
+    # Every day of every state (empty state by design) with the type filter from the request, so
+    # that any date range is answered from the same cached prefix sums
+    try:
+        stats_query = statsQuery(normalizeQuery(date.min, date.max, "", type, self_report_status))
+    except ValueError:
+        # an invalid filter matches nothing
+        return StatsColumns.from_rollups([]).prefix_sums().summarize(start_date.date(), end_date.date(), state)
+    return _stats_response(stats_query, start_date.date(), end_date.date(), state).to_response(request)
+
+
+@cached(cache=INCIDENT_VIEW_CACHE)
+def _stats_response(stats_query, range_start, range_end, state) -> EncodedResponse:
+    stats = getStatsColumns(stats_query.start, stats_query.end, "", stats_query.type, stats_query.self_report_status)
+    return EncodedResponse(stats.prefix_sums().summarize(range_start, range_end, state))
+
+
+@app.route("/stats/cube")
+def get_stats_cube():
+    # return
+    # cells: [{<group_by dimension>: value, ..., "count": count}] sorted by the group_by values
+    # group_by: comma separated day|week|month|year|state|type|self_report_status|incident_source,
+    #   leave state out for national totals
+    # filter: comma separated dimension:value, e.g. type:news,state:NY; like /incidents only
+    #   approved self-reports are counted unless self_report_status is given (admins only)
+    # start/end: optional inclusive dates, all days otherwise
+    try:
+        group_by, filters = parseCubeQuery(request.args.get("group_by", ""), request.args.get("filter", ""))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # Only check admin for self-reports when status is not approved, as /incidents does
+    filter_values = dict(filters)
+    if filter_values.get("type") != "news" and filter_values["self_report_status"] != "approved":
+        _check_is_admin(request)
+    days = []
+    for arg in ("start", "end"):
+        value = request.args.get(arg)
+        day = dateparser.parse(value) if value else None
+        if value and day is None:
+            return jsonify({"error": f"Invalid {arg}: {value}"}), 400
+        days.append(day.date() if day else None)
+    cells = queryIncidentCube(group_by, filters, *days)
+    return {"group_by": list(group_by), "cells": cells}
+
+
+@app.route("/cache_stats")
+def get_cache_stats():
+    _check_is_admin(request)
+    return cache_stats()
 
 
 @app.route("/publish_incidents")
@@ -272,7 +253,7 @@ def register_token():
     if not token:
         raise ValueError("No token detected")
 
-    res = add_token(deviceId, token)
+    get_token_writer().register(deviceId, token)
     return {"success": True}
 
 
@@ -0,0 +1,23 @@
+import sys
+
+from firestore.incidents import Incident
+from firestore.incident_rollups import rebuildRollups, streamRollupFields
+
+# Verify (default) or rebuild the daily incident rollups used by /stats
+#   python rebuild_rollups.py [verify|rebuild]
+
+
+def main(mode):
+    if mode not in ("verify", "rebuild"):
+        raise ValueError("Usage: rebuild_rollups.py [verify|rebuild]")
+    # aggregated as they stream in, memory only grows with the number of (day, state) cells
+    incidents = streamRollupFields(Incident.collection_name)
+    drifted = rebuildRollups(incidents, fix=mode == "rebuild")
+    for day, state in sorted(drifted):
+        print("Drifted rollup:", day, state)
+    print("{} rollup(s) {}".format(len(drifted), "rebuilt" if mode == "rebuild" else "out of date"))
+    return drifted
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else "verify")
@@ -0,0 +1,65 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class TokenBucket:
+    """Blocking token bucket: rate tokens per second, up to capacity at once"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class PublishingExecutor:
+    """Publishes (target, incident) jobs on a bounded thread pool.
+
+    Every target has its own TokenBucket, so a slow or strict API only throttles its own
+    jobs. A publish that raises or returns None is retried up to max_attempts times with
+    exponential backoff and jitter.
+    """
+
+    def __init__(self, publishers, rate_limits, max_workers=8, max_attempts=3, backoff=1.0):
+        self._publishers = publishers  # target : Publisher
+        self._buckets = {target: TokenBucket(*rate_limits[target]) for target in publishers}
+        self._max_workers = max_workers
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+
+    def _publish(self, target, incident):
+        for attempt in range(1, self._max_attempts + 1):
+            self._buckets[target].acquire()
+            try:
+                publish_time = self._publishers[target].publish(incident)
+                if publish_time:
+                    return publish_time
+                print("Failed to publish {} to {} (attempt {})".format(incident.id, target, attempt))
+            except Exception as e:
+                print("Error publishing {} to {} (attempt {}): {}".format(incident.id, target, attempt, e))
+            if attempt < self._max_attempts:
+                time.sleep(self._backoff * 2 ** (attempt - 1) * (1 + random.random()))
+        return None
+
+    def run(self, jobs):
+        """Publish every (target, incident) job; yield (target, incident, publish_time or None) as they finish"""
+        with ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix="publish") as pool:
+            futures = {pool.submit(self._publish, target, incident): (target, incident) for target, incident in jobs}
+            for future in as_completed(futures):
+                target, incident = futures[future]
+                yield target, incident, future.result()
@@ -1,58 +1,119 @@
 from datetime import datetime
+from clients import get_client, register_client
 from social_media_publishers.publisher import Publisher
 from firestore.incidents import Incident
-from firestore.tokens import Token, delete_token
-from datetime import datetime
+from firestore.incident_publish_status import clearPendingRecipients, getPendingRecipients, setPendingRecipients
+from firestore.token_store import get_token_snapshot
 import concurrent.futures
+import threading
+import time
 
 from exponent_server_sdk import (
-    DeviceNotRegisteredError,
     PushClient,
     PushMessage,
     PushServerError,
+    PushTicket,
 )
 
 
+register_client("expo_push", PushClient)
+
+CHUNK_SIZE = 100  # messages per Expo push request
+FANOUT_WORKERS = 8
+# receipts are usually ready within seconds, but Expo keeps them for a day
+RECEIPT_DELAYS = (30, 120, 600)  # seconds before each receipt check
+
+
 class PushNotification(Publisher):
     def __init__(self) -> None:
-        self.push_client = PushClient()
+        self.push_client = get_client("expo_push")
+
+    def _send_chunk(self, messages):
+        try:
+            return self.push_client.publish_multiple(messages)
+        except PushServerError as error:
+            print("Push failed: ", error.__dict__)
+        except Exception as error:
+            print("Push failed: ", error)
+        return None
 
     def publish(self, incident: Incident) -> datetime:
-        # Fetch tokens in batches
-        batch_size = 1000
-        batch_no = 0
-        tokens = Token.collection.fetch(batch_size)
-        res = []
-
-        while True:
-            batch_no += 1
-
-            print(f"Grouping batch {batch_no} ...")
-            push_messages = []
-            for token in tokens:
-                push_messages.append(
-                    PushMessage(
-                        to=token.token,
-                        title=incident.title,
-                        body=incident.abstract,
-                        data={},  # Optional data payload
-                    )
-                )
-            if not push_messages:
-                break
+        # Return None when any chunk fails. The devices of the failed chunks are recorded, and the
+        # retries (by the executor, or the next run) only push to those.
+        pending = getPendingRecipients("notification", incident.id)
+        # token string : device id, from the in-memory snapshot of the token store
+        token_ids = {
+            token: device_id for device_id, token in get_token_snapshot().tokens().items()
+            if pending is None or device_id in pending
+        }
+        messages = [
+            PushMessage(
+                to=token,
+                title=incident.title,
+                body=incident.abstract,
+                data={},  # Optional data payload
+            )
+            for token in token_ids
+        ]
+        chunks = [messages[i:i + CHUNK_SIZE] for i in range(0, len(messages), CHUNK_SIZE)]
+        print(f"Publishing {len(messages)} notifications in {len(chunks)} chunks ...")
 
-            print(f"Publishing batch {batch_no} ...")
-            try:
-                results = self.push_client.publish_multiple(push_messages)
-                res.append(results)
-            except DeviceNotRegisteredError:
-                delete_token(token._id)
-                print("Token Not Registered. Deleted.")
-            except PushServerError as error:
-                print("Push failed: ", error.__dict__)
-            except ValueError:
-                delete_token(token._id)
-                print(f"Invalid push token. Deleted.")
-            tokens.next_fetch()
+        # send the chunks concurrently and collect their tickets
+        invalid = set()
+        tickets = []
+        failed_chunks = 0
+        failed = set()  # device ids of the failed chunks
+        with concurrent.futures.ThreadPoolExecutor(max_workers=FANOUT_WORKERS) as pool:
+            for chunk, chunk_tickets in zip(chunks, pool.map(self._send_chunk, chunks)):
+                if chunk_tickets is None:
+                    failed_chunks += 1
+                    failed.update(token_ids[message.to] for message in chunk)
+                    continue
+                for ticket in chunk_tickets:
+                    if ticket.is_success():
+                        if ticket.id:
+                            tickets.append(ticket)
+                    elif (ticket.details or {}).get("error") == PushTicket.ERROR_DEVICE_NOT_REGISTERED:
+                        invalid.add(token_ids[ticket.push_message.to])
+                    else:
+                        print("Push ticket error:", ticket.message, ticket.details)
 
+        if invalid:
+            print(f"Deleted {get_token_snapshot().delete_tokens(invalid)} unregistered tokens.")
+        if tickets:
+            # receipts carry the delivery errors, check them without holding the cron request
+            threading.Thread(
+                target=self.check_receipts, args=(tickets, token_ids), name="expo-receipts", daemon=True
+            ).start()
+        if failed:
+            print(f"{failed_chunks} of {len(chunks)} chunks failed, {len(failed)} devices left to notify.")
+            if failed_chunks < len(chunks):
+                setPendingRecipients("notification", incident.id, failed)
+            # else nothing was delivered and whoever was pending still is
+            return None
+        if pending is not None:
+            clearPendingRecipients("notification", incident.id)
         return datetime.now()
+
+    def check_receipts(self, tickets, token_ids):
+        # poll the receipts of the tickets, then delete the tokens of unregistered devices in one pass
+        pending = {ticket.id: token_ids[ticket.push_message.to] for ticket in tickets}
+        invalid = set()
+        for delay in RECEIPT_DELAYS:
+            time.sleep(delay)
+            try:
+                receipts = self.push_client.check_receipts_multiple(
+                    [ticket for ticket in tickets if ticket.id in pending]
+                )
+            except Exception as error:
+                print("Receipt check failed: ", error)
+                continue
+            for receipt in receipts:
+                token_id = pending.pop(receipt.id, None)
+                if not receipt.is_success() and (receipt.details or {}).get("error") == PushTicket.ERROR_DEVICE_NOT_REGISTERED:
+                    invalid.add(token_id)
+            if not pending:
+                break
+        invalid.discard(None)
+        if invalid:
+            print(f"Deleted {get_token_snapshot().delete_tokens(invalid)} tokens with DeviceNotRegistered receipts.")
@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class FakeCacheUpdateRef:
+    # stands in for the realtime database reference the caches report their updates to
+    def listen(self, listener):
+        pass
+
+    def set(self, value):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def no_cache_update_listener():
+    from clients import _CLIENTS
+    import firestore.cachemanager  # registers the real client factory
+
+    _CLIENTS["cache_update_db_ref"] = FakeCacheUpdateRef()
+    yield
+    _CLIENTS.pop("cache_update_db_ref", None)
@@ -0,0 +1,71 @@
+from datetime import date, datetime
+
+import pytest
+
+from firestore.cachemanager import INCIDENT_CACHE, INCIDENT_STATS_CACHE, INCIDENT_VIEW_CACHE, _overlaps, evict_cache
+from firestore.incident_index import cache_scopes
+from firestore.incident_query import normalizeQuery, statsQuery
+
+MARCH = normalizeQuery(date(2021, 3, 1), date(2021, 3, 31))
+
+
+def _scope(day="2021-03-05", state="CA", type="news"):
+    return {"id": "a", "day": day, "state": state, "type": type}
+
+
+@pytest.mark.parametrize("query,scope,overlaps", [
+    (MARCH, _scope(), True),
+    (MARCH, _scope(day="2021-03-01"), True),
+    (MARCH, _scope(day="2021-03-31"), True),
+    (MARCH, _scope(day="2021-04-01"), False),
+    (MARCH, _scope(day="2021-02-28"), False),
+    (MARCH._replace(state="CA"), _scope(), True),
+    (MARCH._replace(state="NY"), _scope(), False),
+    # an incident without a location is only in the nation wide queries
+    (MARCH._replace(state="CA"), _scope(state=""), False),
+    (MARCH, _scope(state=""), True),
+    (MARCH._replace(type="news"), _scope(), True),
+    (MARCH._replace(type="self_report"), _scope(), False),
+    (MARCH._replace(type="self_report"), _scope(type="self_report"), True),
+])
+def test_overlaps(query, scope, overlaps):
+    assert _overlaps(query, scope) == overlaps
+
+
+@pytest.fixture
+def caches():
+    caches = (INCIDENT_CACHE, INCIDENT_STATS_CACHE, INCIDENT_VIEW_CACHE)
+    for cache in caches:
+        cache.clear()
+    yield caches
+    for cache in caches:
+        cache.clear()
+
+
+def test_evict_cache_only_evicts_the_overlapping_queries(caches):
+    incident_cache, stats_cache, view_cache = caches
+    april = normalizeQuery(date(2021, 4, 1), date(2021, 4, 30))
+    ny = MARCH._replace(state="NY")
+    for query in (MARCH, april, ny):
+        incident_cache[(query,)] = "incidents"
+        stats_cache[(statsQuery(query),)] = "stats"
+        view_cache[(query, "gzip")] = "view"
+    view_cache[("not a query",)] = "view"
+
+    # an incident moved from NY in February to CA in March
+    evict_cache(cache_scopes(
+        "a",
+        {"incident_time": datetime(2021, 2, 20), "incident_location": "NY", "type": "news"},
+        {"incident_time": datetime(2021, 3, 5), "incident_location": "CA", "type": "news"},
+    ))
+    assert list(incident_cache) == [(april,), (ny,)]
+    assert list(stats_cache) == [(statsQuery(april),), (statsQuery(ny),)]
+    # anything not keyed on a query is evicted, to be safe
+    assert list(view_cache) == [(april, "gzip"), (ny, "gzip")]
+
+
+def test_evict_cache_without_scopes_keeps_everything(caches):
+    incident_cache = caches[0]
+    incident_cache[(MARCH,)] = "incidents"
+    evict_cache([])
+    assert list(incident_cache) == [(MARCH,)]
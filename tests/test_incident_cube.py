@@ -0,0 +1,104 @@
+import random
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from firestore.incident_cube import TIME_LEVELS, IncidentCube, parseCubeQuery
+
+FIRST_DAY = date(2020, 12, 20)
+
+
+def _incident(rng, incident_id):
+    return {
+        "id": incident_id,
+        "incident_time": datetime.combine(FIRST_DAY + timedelta(days=rng.randrange(0, 420)), datetime.min.time()),
+        "incident_location": rng.choice(["CA", "NY", "TX", ""]),
+        "type": rng.choice(["news", "self_report", "self_report", "other"]),
+        "self_report_status": rng.choice(["approved", "new", "rejected", None]),
+        "incident_source": rng.choice(["ap", "twitter", ""]),
+    }
+
+
+def _query_rows(incidents, group_by, filters, start, end):
+    # the cube query computed incident by incident
+    filters = dict(filters)
+    status = filters.pop("self_report_status", "all")
+    groups = Counter()
+    for incident in incidents:
+        if incident["type"] not in ("news", "self_report"):
+            continue
+        day = incident["incident_time"].date()
+        values = {
+            "day": day,
+            "state": incident["incident_location"],
+            "type": incident["type"],
+            "self_report_status": (incident["self_report_status"] or "") if incident["type"] == "self_report" else "",
+            "incident_source": incident["incident_source"],
+        }
+        if (start and day < start) or (end and day > end):
+            continue
+        if any(values[d] != value for d, value in filters.items()):
+            continue
+        if status != "all" and incident["type"] == "self_report" and values["self_report_status"] != status:
+            continue
+        groups[tuple(TIME_LEVELS[d](day) if d in TIME_LEVELS else values[d] for d in group_by)] += 1
+    return [dict(zip(group_by, group), count=count) for group, count in sorted(groups.items())]
+
+
+QUERIES = [
+    ("", "", None, None),
+    ("year", "", None, None),
+    ("month,state", "type:news", date(2021, 1, 1), date(2021, 6, 30)),
+    ("month", "state:NY,self_report_status:all", date(2021, 1, 15), date(2021, 6, 30)),
+    ("week", "type:self_report", date(2021, 1, 4), date(2021, 3, 28)),
+    ("year,type", "incident_source:ap", date(2021, 1, 1), date(2021, 12, 31)),
+    ("day,self_report_status", "", date(2021, 2, 1), date(2021, 2, 10)),
+    ("state", "self_report_status:new", date(2021, 3, 1), None),
+]
+
+
+@pytest.mark.parametrize("group_by,filter,start,end", QUERIES)
+def test_cube_matches_the_incidents_under_updates(group_by, filter, start, end):
+    rng = random.Random(group_by + filter)
+    incidents = {i: _incident(rng, i) for i in range(300)}
+    cube = IncidentCube(incidents.values())
+    group_by, filters = parseCubeQuery(group_by, filter)
+    assert cube.query(group_by, filters, start, end) == _query_rows(incidents.values(), group_by, filters, start, end)
+
+    # inserts, moves between cells and removals, queried in between
+    for step in range(200):
+        incident_id = rng.randrange(0, 350)
+        old = incidents.get(incident_id)
+        new = None if old and rng.random() < 0.3 else _incident(rng, incident_id)
+        cube.update(old, new)
+        if new:
+            incidents[incident_id] = new
+        else:
+            del incidents[incident_id]
+        if step % 50 == 0:
+            assert cube.query(group_by, filters, start, end) == _query_rows(incidents.values(), group_by, filters, start, end)
+    assert cube.query(group_by, filters, start, end) == _query_rows(incidents.values(), group_by, filters, start, end)
+
+
+def test_removing_the_last_incident_of_a_cell_empties_every_level():
+    incident = {"incident_time": datetime(2021, 5, 3), "incident_location": "CA", "type": "news"}
+    cube = IncidentCube([incident])
+    cube.update(incident, None)
+    assert cube.query(("year",), ()) == []
+    assert all(not counts for counts in cube._counts.values())
+
+
+@pytest.mark.parametrize("group_by,filter", [
+    ("quarter", ""),
+    ("", "type:other"),
+    ("", "self_report_status:pending"),
+    ("", "city:Austin"),
+])
+def test_invalid_cube_queries_raise_value_error(group_by, filter):
+    with pytest.raises(ValueError):
+        parseCubeQuery(group_by, filter)
+
+
+def test_cube_query_type_accepts_the_admin_ui_spelling():
+    assert parseCubeQuery("", "type:Self-Report")[1] == (("self_report_status", "approved"), ("type", "self_report"))
@@ -0,0 +1,71 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+from firestore.incident_index import IncidentIndex
+
+FIRST_DAY = datetime(2021, 1, 1)
+
+
+def _incident(rng, incident_id):
+    return {
+        "id": incident_id,
+        "incident_time": FIRST_DAY + timedelta(hours=rng.randrange(0, 24 * 90)),
+        "incident_location": rng.choice(["CA", "NY", "TX"]),
+        "type": rng.choice(["news", "self_report"]),
+        "self_report_status": rng.choice(["approved", "new", "rejected"]),
+    }
+
+
+def _ids(index, **filters):
+    return [incident["id"] for incident in index.query(FIRST_DAY, FIRST_DAY + timedelta(days=90), **filters)]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_apply_matches_an_index_built_from_the_result(seed):
+    rng = random.Random(seed)
+    incidents = {str(i): _incident(rng, str(i)) for i in range(200)}
+    index = IncidentIndex(incidents.values())
+    cube = index.cube()
+
+    for _ in range(5):
+        # updates, inserts and removals, some of them of ids already changed in the same call
+        ids = rng.sample(range(260), 80)
+        upserts = [_incident(rng, str(i)) for i in ids[:50]]
+        removals = [str(i) for i in ids[40:]]
+        before = dict(incidents)
+        for incident_id in removals:
+            incidents.pop(incident_id, None)
+        for incident in upserts:
+            incidents[incident["id"]] = incident  # an id both upserted and removed is upserted
+        replaced = index.apply(upserts, removals)
+
+        assert replaced == {incident_id: before.get(incident_id) for incident_id in replaced}
+        assert set(replaced) == {str(i) for i in ids}
+        expected = IncidentIndex(incidents.values())
+        assert index.size == expected.size
+        assert {p: lists for p, lists in index._partitions.items() if lists[0]} == expected._partitions
+        for filters in ({}, {"state": "CA"}, {"type": "news"}, {"state": "NY", "type": "self_report", "self_report_status": "all"}):
+            assert _ids(index, **filters) == _ids(expected, **filters)
+        assert cube.query(("month", "state")) == expected.cube().query(("month", "state"))
+
+
+def test_remove_returns_the_removed_incident():
+    rng = random.Random(0)
+    incident = _incident(rng, "a")
+    index = IncidentIndex([incident])
+    assert index.remove("a") == incident
+    assert index.remove("a") is None
+    assert index.size == 0
+    assert _ids(index, self_report_status="all") == []
+
+
+def test_upsert_moves_the_incident_between_partitions():
+    incident = {"id": "a", "incident_time": FIRST_DAY, "incident_location": "CA", "type": "self_report",
+                "self_report_status": "new"}
+    index = IncidentIndex([incident])
+    index.upsert(dict(incident, self_report_status="approved", incident_location="NY"))
+    assert _ids(index, state="CA", self_report_status="all") == []
+    assert _ids(index, state="NY") == ["a"]
+    assert index.get("a")["self_report_status"] == "approved"
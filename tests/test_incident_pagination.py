@@ -0,0 +1,127 @@
+import base64
+import json
+import random
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+import firestore.incidents as incidents
+from firestore.cachemanager import INCIDENT_CACHE
+from firestore.incident_index import IncidentIndex, sort_key
+from firestore.incident_query import MAX_PAGE_SIZE, DEFAULT_PAGE_SIZE, normalizeQuery
+
+START, END = date(2021, 1, 1), date(2021, 12, 31)
+
+
+def _incidents(n, seed=1):
+    rng = random.Random(seed)
+    result = []
+    for i in range(n):
+        type = rng.choice(["news", "self_report"])
+        result.append({
+            "id": "incident-{:05d}".format(i),
+            # few distinct times, so pages often end inside a run of equal incident_time
+            "incident_time": datetime(2020, 12, 20) + timedelta(hours=rng.randrange(0, 24 * 400, 6)),
+            "incident_location": rng.choice(["CA", "NY", "TX"]),
+            "type": type,
+            "self_report_status": rng.choice(["approved", "new", "rejected"]) if type == "self_report" else None,
+        })
+    return result
+
+
+@pytest.fixture
+def stored(monkeypatch):
+    stored = _incidents(2500)
+    index = IncidentIndex(stored)
+    monkeypatch.setattr(incidents, "loadIncidentIndex", lambda: index)
+    INCIDENT_CACHE.clear()
+    yield stored
+    INCIDENT_CACHE.clear()
+
+
+def _expected(stored, state=""):
+    # news and approved self-reports within START..END, newest first
+    matching = [
+        incident for incident in stored
+        if START <= incident["incident_time"].date() <= END
+        and (incident["type"] == "news" or incident["self_report_status"] == "approved")
+        and (not state or incident["incident_location"] == state)
+    ]
+    return sorted(matching, key=sort_key, reverse=True)
+
+
+def _page(page_token="", start_row="", page_size="", state=""):
+    return incidents.queryIncidentsPage(normalizeQuery(START, END, state, "", "", start_row, page_size, page_token))
+
+
+@pytest.mark.parametrize("page_size,state", [("100", ""), ("7", "NY"), ("1000", "")])
+def test_next_page_token_returns_every_incident_once_newest_first(stored, page_size, state):
+    returned, page_token = [], ""
+    while True:
+        page = _page(page_token, page_size=page_size, state=state)
+        returned.extend(page["incidents"])
+        assert page["page_info"]["total_records"] == len(_expected(stored, state))
+        page_token = page["page_info"]["next_page_token"]
+        if not page_token:
+            break
+    assert [incident["id"] for incident in returned] == [incident["id"] for incident in _expected(stored, state)]
+
+
+def test_next_page_token_is_none_on_the_last_page(stored):
+    expected = _expected(stored, "NY")
+    assert len(expected) < MAX_PAGE_SIZE
+    page = _page(page_size=str(len(expected) + 1), state="NY")
+    assert len(page["incidents"]) == len(expected)
+    assert page["page_info"]["next_page_token"] is None
+
+
+def test_start_row_skips_rows_of_the_first_page(stored):
+    expected = _expected(stored)
+    page = _page(start_row="5", page_size="10")
+    assert [i["id"] for i in page["incidents"]] == [i["id"] for i in expected[5:15]]
+    assert _page(start_row=str(len(expected) + 10))["incidents"] == []
+
+
+@pytest.mark.parametrize("start_row,page_size,expected_start_row,expected_page_size", [
+    ("", "", 0, DEFAULT_PAGE_SIZE),
+    ("-3", "abc", 0, DEFAULT_PAGE_SIZE),
+    ("2", "0", 2, 1),
+    ("0", "5000", 0, MAX_PAGE_SIZE),
+])
+def test_start_row_and_page_size_are_clamped(start_row, page_size, expected_start_row, expected_page_size):
+    query = normalizeQuery(START, END, "", "", "", start_row, page_size)
+    assert (query.start_row, query.page_size) == (expected_start_row, expected_page_size)
+
+
+def test_page_token_overrides_start_row(stored):
+    first = _page(page_size="10")
+    page = _page(first["page_info"]["next_page_token"], start_row="5", page_size="10")
+    assert page["page_info"]["start_row"] == 0
+    assert [i["id"] for i in page["incidents"]] == [i["id"] for i in _expected(stored)[10:20]]
+
+
+def _token(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode("utf-8")).decode("ascii")
+
+
+def test_page_token_with_a_utc_offset_continues_after_the_same_incident(stored):
+    first = _page(page_size="10")
+    last = first["incidents"][-1]
+    time = last["incident_time"].replace(tzinfo=timezone.utc).astimezone(timezone(timedelta(hours=2)))
+    page = _page(_token([time.isoformat(), last["id"]]), page_size="10")
+    assert [i["id"] for i in page["incidents"]] == [i["id"] for i in _expected(stored)[10:20]]
+
+
+@pytest.mark.parametrize("page_token", [
+    "not a token!",
+    "é",
+    _token(5),
+    _token([1, 2]),
+    _token(["yesterday", "incident-00001"]),
+    _token(["2021-01-01T00:00:00", "incident-00001", "extra"]),
+    _token(["2021-06-01T00:00:00", 5]),
+    _token(["2021-06-01T00:00:00", None]),
+])
+def test_invalid_page_token_returns_an_error(stored, page_token):
+    page = _page(page_token)
+    assert page == {"error": "Invalid page_token: " + page_token}
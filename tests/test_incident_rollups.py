@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import firestore.incident_rollups as incident_rollups
+from firestore.incident_rollups import updateRollups
+
+
+class RecordingBatch:
+    # applies the merged counter increments of set(..., merge=True) to plain dicts
+    def __init__(self):
+        self.rollups = {}  # doc id : {"news": n, "self_report": {status: n}}
+        self.writes = 0
+
+    def set(self, ref, data, merge=False):
+        assert merge
+        self.writes += 1
+        rollup = self.rollups.setdefault(ref, {"news": 0, "self_report": {}})
+        if "news" in data:
+            rollup["news"] += data["news"].value
+        for status, increment in data.get("self_report", {}).items():
+            rollup["self_report"][status] = rollup["self_report"].get(status, 0) + increment.value
+
+    def counts(self):
+        # the non zero counters, as {(doc id, field): count}
+        counts = {(ref, "news"): rollup["news"] for ref, rollup in self.rollups.items()}
+        counts.update({
+            (ref, status): count for ref, rollup in self.rollups.items() for status, count in rollup["self_report"].items()
+        })
+        return {key: count for key, count in counts.items() if count}
+
+
+@pytest.fixture
+def batch(monkeypatch):
+    monkeypatch.setattr(incident_rollups, "_rollup_ref", lambda day, state: "{}_{}".format(day, state))
+    return RecordingBatch()
+
+
+def _report(**fields):
+    return {"incident_time": datetime(2021, 3, 5, 12), "incident_location": "CA", "type": "self_report",
+            "self_report_status": "new", **fields}
+
+
+def test_insert_and_delete_add_and_remove_one_count(batch):
+    updateRollups(batch, None, _report())
+    assert batch.counts() == {("2021-03-05_CA", "new"): 1}
+    updateRollups(batch, _report(), None)
+    assert batch.counts() == {}
+
+
+def test_moderation_moves_the_count_between_statuses(batch):
+    updateRollups(batch, None, _report())
+    updateRollups(batch, _report(), _report(self_report_status="approved"))
+    assert batch.counts() == {("2021-03-05_CA", "approved"): 1}
+
+
+@pytest.mark.parametrize("changes,cell", [
+    ({"incident_location": "NY"}, ("2021-03-05_NY", "new")),
+    ({"incident_time": datetime(2021, 3, 6, 1)}, ("2021-03-06_CA", "new")),
+    # counted on the UTC day
+    ({"incident_time": datetime(2021, 3, 5, 20, tzinfo=timezone(-timedelta(hours=8)))}, ("2021-03-06_CA", "new")),
+    ({"type": "news"}, ("2021-03-05_CA", "news")),
+])
+def test_edits_move_the_count_to_the_new_cell(batch, changes, cell):
+    updateRollups(batch, None, _report())
+    updateRollups(batch, _report(), _report(**changes))
+    assert batch.counts() == {cell: 1}
+
+
+def test_edits_within_the_cell_do_not_write(batch):
+    updateRollups(batch, _report(), _report(incident_time=datetime(2021, 3, 5, 23), title="edited"))
+    assert batch.writes == 0
+
+
+@pytest.mark.parametrize("incident", [
+    _report(type="other"),
+    _report(incident_time=None),
+])
+def test_uncounted_incidents_do_not_write(batch, incident):
+    updateRollups(batch, None, incident)
+    updateRollups(batch, incident, None)
+    assert batch.writes == 0
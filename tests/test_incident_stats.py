@@ -0,0 +1,87 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+
+from firestore.incident_stats import StatsColumns
+
+STATES = ["CA", "NY", "TX", ""]
+FIRST_DAY = date(2020, 11, 20)
+
+
+def _rollups(seed):
+    rng = random.Random(seed)
+    rollups = []
+    for _ in range(400):
+        day = FIRST_DAY + timedelta(days=rng.randrange(0, 200))
+        rollups.append({
+            "day": day.isoformat(),
+            "incident_location": rng.choice(STATES),
+            "news": rng.choice([0, 0, 1, 3]),
+            "self_report": {status: rng.randrange(0, 3) for status in rng.sample(["approved", "new", "rejected"], 2)},
+        })
+    # the stored rollups are unique per (day, state)
+    return list({(r["day"], r["incident_location"]): r for r in rollups}.values())
+
+
+def _summarize_rows(rollups, type, self_report_status, range_start, range_end, state):
+    # The /stats body computed row by row, as the per-query columns did before the prefix sums:
+    # stats, total and insight over the range, monthly_stats over its whole months
+    def counts(rollup):
+        self_report = rollup["self_report"]
+        news = rollup["news"] if type in ("both", "news") else 0
+        if type not in ("both", "self_report"):
+            reports = 0
+        elif self_report_status == "all":
+            reports = sum(self_report.values())
+        else:
+            reports = self_report.get(self_report_status, 0)
+        return news, reports
+
+    def add(totals, key, news, reports):
+        previous = totals.get(key, {"news": 0, "self_report": 0})
+        totals[key] = {"news": previous["news"] + news, "self_report": previous["self_report"] + reports}
+
+    insight, daily, monthly = {}, {}, {}
+    for rollup in rollups:
+        day = date.fromisoformat(rollup["day"])
+        news, reports = counts(rollup)
+        if not news and not reports:
+            continue
+        in_state = not state or rollup["incident_location"] == state
+        if range_start <= day <= range_end:
+            add(insight, rollup["incident_location"], news, reports)
+            if in_state:
+                add(daily, rollup["day"], news, reports)
+        if in_state and range_start <= range_end and \
+                range_start.replace(day=1) <= day.replace(day=1) <= range_end.replace(day=1):
+            add(monthly, rollup["day"][:7], news, reports)
+    return {
+        "stats": [dict(key=key, **daily[key]) for key in sorted(daily, reverse=True)],
+        "total": {name: value["news"] + value["self_report"] for name, value in insight.items()},
+        "monthly_stats": {key: monthly[key] for key in sorted(monthly, reverse=True)},
+        "insight": insight,
+    }
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("type,self_report_status", [("both", "approved"), ("news", "approved"), ("self_report", "all")])
+def test_summarize_matches_the_per_row_aggregation(seed, type, self_report_status):
+    rng = random.Random(seed)
+    rollups = _rollups(seed)
+    prefix_sums = StatsColumns.from_rollups(rollups, type, self_report_status).prefix_sums()
+    for _ in range(50):
+        # ranges inside, across and outside the covered days, and some reversed ones
+        range_start = FIRST_DAY + timedelta(days=rng.randrange(-40, 240))
+        range_end = range_start + timedelta(days=rng.randrange(-5, 120))
+        state = rng.choice(STATES[:-1] + ["", "WA"])
+        summary = prefix_sums.summarize(range_start, range_end, state)
+        expected = _summarize_rows(rollups, type, self_report_status, range_start, range_end, state)
+        assert summary == expected
+        # newest first
+        assert list(summary["monthly_stats"]) == list(expected["monthly_stats"])
+
+
+def test_summarize_without_rollups():
+    summary = StatsColumns.from_rollups([]).prefix_sums().summarize(date(2021, 1, 1), date(2021, 12, 31))
+    assert summary == {"stats": [], "total": {}, "monthly_stats": {}, "insight": {}}
@@ -0,0 +1,52 @@
+import pytest
+
+from location_resolver import LocationResolver
+
+ZIPS = [
+    ("95032", 37.23, -121.96, "Los Gatos", "CA"),
+    ("78759", 30.40, -97.75, "Austin", "TX"),
+    ("10099", 40.75, -73.99, "New York", "NY"),
+    ("97201", 45.51, -122.69, "Portland", "OR"),
+    ("04101", 43.66, -70.26, "Portland", "ME"),
+]
+CITIES = [
+    ("San Francisco", "California", 870000, 37.77, -122.42),
+    ("Portland", "Oregon", 650000, 45.52, -122.68),
+    ("Portland", "Maine", 66000, 43.66, -70.26),
+    ("Springfield", "Narnia", 1000, 0.0, 0.0),
+]
+
+
+@pytest.fixture(scope="module")
+def resolver():
+    return LocationResolver(ZIPS, CITIES)
+
+
+@pytest.mark.parametrize("address,state", [
+    ("Garden Ln & Los Gatos Blvd, Los Gatos, CA 95032", "CA"),
+    # a house number that is also a ZIP code does not beat the state code
+    ("10099 Research Blvd, Austin, TX 78759", "TX"),
+    ("10099 Research Blvd, Austin, 78759", "TX"),
+    ("Main St, Albany, NY", "NY"),
+    ("Downtown, New Mexico", "NM"),
+    ("Capitol Hill, District of Columbia", "DC"),
+    ("Outer Sunset, San Francisco", "CA"),
+    # the most populated city of that name
+    ("Pearl District, Portland", "OR"),
+    # cities only known from the ZIP codes, in a single state
+    ("Los Gatos", "CA"),
+    ("Somewhere, Springfield", None),
+    ("", None),
+])
+def test_state_of_address(resolver, address, state):
+    assert resolver.state_of_address(address) == state
+
+
+@pytest.mark.parametrize("lat,lon,state", [
+    (37.78, -122.40, "CA"),
+    (43.70, -70.30, "ME"),
+    (30.60, -97.70, "TX"),  # about 23 km from Austin
+    (35.00, -100.00, None),  # nothing within 50 km
+])
+def test_state_at(resolver, lat, lon, state):
+    assert resolver.state_at(lat, lon) == state
@@ -0,0 +1,73 @@
+import pytest
+
+from firestore.token_store import CoalescingTokenWriter, TokenStore
+
+
+class MemoryTokenStore(TokenStore):
+    name = "memory"
+
+    def __init__(self):
+        self.tokens = {}
+        self.writes = []  # the {device_id: token} of every add_tokens
+        self.fail = False
+
+    def add_token(self, device_id, token):
+        self.add_tokens({device_id: token})
+
+    def add_tokens(self, tokens):
+        if self.fail:
+            raise RuntimeError("unavailable")
+        self.writes.append(dict(tokens))
+        self.tokens.update(tokens)
+
+    def delete_tokens(self, device_ids):
+        for device_id in device_ids:
+            self.tokens.pop(device_id, None)
+
+    def scan(self):
+        yield from self.tokens.items()
+
+
+@pytest.fixture
+def writer():
+    # flushed by the tests only
+    writer = CoalescingTokenWriter(MemoryTokenStore(), flush_interval=3600, max_batch=1000)
+    yield writer
+    writer.close()
+
+
+def test_the_latest_token_of_a_device_is_written_once(writer):
+    assert writer.register("a", "t1")
+    assert writer.register("a", "t2")
+    assert not writer.register("a", "t2")
+    assert writer.register("b", "t3")
+    assert writer.flush() == 2
+    assert writer.store.writes == [{"a": "t2", "b": "t3"}]
+
+
+def test_registrations_of_the_written_token_are_dropped(writer):
+    writer.register("a", "t1")
+    writer.flush()
+    assert not writer.register("a", "t1")
+    assert writer.flush() == 0
+    # a new token, and going back to the old one while it is pending
+    assert writer.register("a", "t2")
+    assert writer.register("a", "t1")
+    writer.flush()
+    assert writer.store.writes == [{"a": "t1"}, {"a": "t1"}]
+
+
+def test_a_failed_flush_is_retried_by_the_next_one(writer):
+    writer.register("a", "t1")
+    writer.register("b", "t2")
+    writer.store.fail = True
+    assert writer.flush() == 0
+    assert writer.store.writes == []
+    # still pending, so not dropped as already written
+    assert not writer.register("a", "t1")
+    # a newer registration wins over the failed one
+    writer.register("b", "t3")
+    writer.store.fail = False
+    assert writer.flush() == 2
+    assert writer.store.tokens == {"a": "t1", "b": "t3"}
+    assert not writer.register("b", "t3")
@@ -1,82 +1,210 @@
-from firestore.incidents import (insertIncident)
-from google.cloud import translate
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-translate_api_client = translate.TranslationServiceClient()
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP
+
+from clients import get_client, register_client
+from firestore.incident_query import IncidentQuery
+from firestore.incidents import queryIncidentsPage, updateIncidentTranslations
+from translation_memory import TranslationMemory
+
+
+def _create_translation_client():
+    from google.cloud import translate
+    return translate.TranslationServiceClient()
+
+
+register_client("translate", _create_translation_client)
+register_client(
+    "translation_memory",
+    # App Engine standard only allows writes under /tmp
+    lambda: TranslationMemory(os.getenv(
+        'TRANSLATION_MEMORY_PATH', os.path.join(tempfile.gettempdir(), 'translation_memory.sqlite3')
+    ))
+)
 LOCATION = "global"
 PROJECT_ID='hate-crime-tracker'
 PARENT = f"projects/{PROJECT_ID}/locations/{LOCATION}"
+SOURCE_LANG='en-US'
 BATCH_SIZE=50
+# Cloud Translation limits of a single translate_text request
+MAX_REQUEST_CONTENTS=1024
+MAX_REQUEST_CODEPOINTS=30000
+
+def is_english(lang):
+    return lang == 'en' or lang == 'en_US'
+
+def split_request(contents):
+    # split texts into chunks within the per-request content and codepoint limits
+    chunk, codepoints = [], 0
+    for text in contents:
+        if chunk and (len(chunk) == MAX_REQUEST_CONTENTS or codepoints + len(text) > MAX_REQUEST_CODEPOINTS):
+            yield chunk
+            chunk, codepoints = [], 0
+        chunk.append(text)
+        codepoints += len(text)
+    if chunk:
+        yield chunk
 
 def translate_batch(batch, target_lang):
+    # return [(translated title, translated abstract)] in the order of batch
     if len(batch) == 0:
-        return
-    translated_batch = []
+        return []
+    texts = []
     for incident in batch:
-        translated_batch.append(incident['title'])
-        translated_batch.append(incident['abstract'])
-    response = translate_api_client.translate_text(
-            parent = PARENT,
-            contents = translated_batch,
-            mime_type = 'text/plain',  # mime types: text/plain, text/html
-            source_language_code = 'en-US',
-            target_language_code = target_lang
-    )
-    if len(response.translations) != len(translated_batch):
-        raise SystemError('Translation result count {0} does not match original {1}'
-            .format(len(response.translations), len(translated_batch)))
-
-    for i in range(len(batch)):
-        if batch[i].get('abstract_translate') is None:
-            batch[i]['abstract_translate'] = {}
-        if batch[i].get('title_translate') is None:
-            batch[i]['title_translate'] = {}
-
-        batch[i]['title_translate'].update({
-            target_lang: response.translations[i*2].translated_text
-        })
-        batch[i]['abstract_translate'].update({
-            target_lang: response.translations[i*2+1].translated_text
-        })
-    return batch
-
-def save_batch(batch):
-    for incident in batch:
-        insertIncident(incident)
+        texts.append(incident.get('title') or '')
+        texts.append(incident.get('abstract') or '')
+    # only send the distinct texts the translation memory does not know yet
+    memory = get_client("translation_memory")
+    translated = memory.lookup(texts, SOURCE_LANG, target_lang)
+    translated[''] = ''
+    contents = list(dict.fromkeys(text for text in texts if text not in translated))
+    for request_contents in split_request(contents):
+        response = get_client("translate").translate_text(
+                parent = PARENT,
+                contents = request_contents,
+                mime_type = 'text/plain',  # mime types: text/plain, text/html
+                source_language_code = SOURCE_LANG,
+                target_language_code = target_lang
+        )
+        if len(response.translations) != len(request_contents):
+            raise SystemError('Translation result count {0} does not match original {1}'
+                .format(len(response.translations), len(request_contents)))
+        new_translations = {text: t.translated_text for text, t in zip(request_contents, response.translations)}
+        memory.store(new_translations, SOURCE_LANG, target_lang)
+        translated.update(new_translations)
+
+    return [(translated[texts[i*2]], translated[texts[i*2+1]]) for i in range(len(batch))]
+
+def translate_and_save(incidents, target_lang):
+    for start in range(0, len(incidents), BATCH_SIZE):
+        batch = incidents[start:start + BATCH_SIZE]
+        translations = translate_batch(batch, target_lang)
+        updateIncidentTranslations(
+            [(incident, title, abstract) for incident, (title, abstract) in zip(batch, translations)],
+            target_lang
+        )
+
+
+class TranslationCoordinator:
+    """Merges the translation work of concurrent requests into shared batches.
+
+    Incidents are queued per target language; an (incident id, language) pair already queued
+    or being translated is not queued again (single flight). Each language is drained by one
+    task of a thread pool, which waits BATCH_WINDOW seconds so a burst of requests ends up in
+    the same batches, then translates BATCH_SIZE incidents at a time. Different languages are
+    translated in parallel.
+    """
+
+    BATCH_WINDOW = 0.2  # seconds
 
-#translate and save batch of incidents if the given language does not exist
+    def __init__(self, max_workers=4):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="translation")
+        self._pending = {}  # target_lang -> OrderedDict(incident id -> incident)
+        self._in_flight = set()  # (incident id, target_lang) queued or being translated
+        self._draining = set()  # target_lang with a scheduled drain task
+        self._idle = threading.Condition()
+
+    def submit(self, incidents, target_lang):
+        with self._idle:
+            pending = self._pending.setdefault(target_lang, OrderedDict())
+            for incident in incidents:
+                if (incident['id'], target_lang) not in self._in_flight:
+                    self._in_flight.add((incident['id'], target_lang))
+                    pending[incident['id']] = incident
+            if pending and target_lang not in self._draining:
+                self._draining.add(target_lang)
+                self._executor.submit(self._drain, target_lang)
+
+    def join(self):
+        # wait until every submitted incident is translated
+        with self._idle:
+            self._idle.wait_for(lambda: not self._draining)
+
+    def _next_batch(self, target_lang):
+        with self._idle:
+            pending = self._pending[target_lang]
+            batch = [pending.popitem(last=False)[1] for _ in range(min(BATCH_SIZE, len(pending)))]
+            if not batch:
+                self._draining.discard(target_lang)
+                self._idle.notify_all()
+            return batch
+
+    def _drain(self, target_lang):
+        time.sleep(self.BATCH_WINDOW)
+        batch = self._next_batch(target_lang)
+        while batch:
+            try:
+                translate_and_save(batch, target_lang)
+            except Exception as e:
+                print("Failed to translate {} incidents to {}: {}".format(len(batch), target_lang, e))
+            finally:
+                with self._idle:
+                    self._in_flight.difference_update((i['id'], target_lang) for i in batch)
+            batch = self._next_batch(target_lang)
+
+
+class InlineTranslationQueue:
+    """Stand-in for TranslationCoordinator that translates synchronously, for tests and local runs"""
+
+    def submit(self, incidents, target_lang):
+        translate_and_save(incidents, target_lang)
+
+    def join(self):
+        pass
+
+
+# TRANSLATION_QUEUE=inline translates within the request, as before
+register_client(
+    "translation_queue",
+    InlineTranslationQueue if os.getenv('TRANSLATION_QUEUE') == 'inline' else TranslationCoordinator
+)
+
+# queue the incidents missing the given language for translation, and return them as they are
 # do not translate en or en_US
 def translate_incidents(incidents, target_lang):
-    if target_lang == 'en' or target_lang == 'en_US':
+    if is_english(target_lang):
         return incidents
-    batch = []
-    for incident in incidents:
-        # check if the target language exists
-        if incident.get('title_translate', None) and incident.get('title_translate', {}).get(target_lang) is not None:
-            continue
-        batch.append(incident)
-        if len(batch) >= BATCH_SIZE:
-            batch = translate_batch(batch, target_lang)
-            save_batch(batch)
-            batch = []
-    if len(batch) > 0:
-        batch = translate_batch(batch, target_lang)
-        save_batch(batch)
-    return incidents #when translate batchs, incidents in incidents should be updated too
+    missing = [
+        incident for incident in incidents
+        # '' is a saved translation too (self-reports have no title)
+        if (incident.get('title_translate') or {}).get(target_lang) is None
+    ]
+    if missing:
+        get_client("translation_queue").submit(missing, target_lang)
+    return incidents
+
+# keep only the requested language; incidents not translated yet fall back to English
+def project_incident(incident, target_lang, is_en):
+    projected = dict(incident)
+    if projected.get('created_on') == SERVER_TIMESTAMP:
+        projected['created_on'] = None  # not written yet, the sentinel is not serializable
+    if is_en:
+        projected['title_translate'] = {}
+        projected['abstract_translate'] = {}
+    else:
+        projected['title_translate'] = {
+            target_lang : (incident.get('title_translate') or {}).get(target_lang) or incident.get('title') or ""
+        }
+        projected['abstract_translate'] = {
+            target_lang : (incident.get('abstract_translate') or {}).get(target_lang) or incident.get('abstract') or ""
+        }
+    return projected
 
 def clean_unused_translation(orig_incidents, target_lang):
-    is_en = target_lang == 'en' or target_lang == 'en_US'
-    cleaned_incidents = []
-    for orig_incident in orig_incidents:
-        incident = orig_incident.copy()
-        if is_en:
-            incident['title_translate'] = {}
-            incident['abstract_translate'] = {}
-        else:
-            incident['title_translate'] = {
-                target_lang : incident['title_translate'].get(target_lang, "")
-            }
-            incident['abstract_translate'] = {
-                target_lang : incident['abstract_translate'].get(target_lang, "")
-            }
-        cleaned_incidents.append(incident)
-    return cleaned_incidents
\ No newline at end of file
+    is_en = is_english(target_lang)
+    return [project_incident(incident, target_lang, is_en) for incident in orig_incidents]
+
+# The /incidents response of a query in one language
+def incidents_view(query: IncidentQuery, target_lang):
+    page = queryIncidentsPage(query)
+    if "error" in page:
+        return page
+    return {
+        "page_info": page["page_info"],
+        "incidents": clean_unused_translation(translate_incidents(page["incidents"], target_lang), target_lang),
+    }
@@ -0,0 +1,75 @@
+import hashlib
+import sqlite3
+import threading
+
+from cachetools import LRUCache
+
+# Persistent translation memory: translated text keyed by (sha256(source text), source
+# language, target language), stored in a local SQLite file with an in-process LRU in front.
+# Identical titles/abstracts (re-imported incidents, abstracts reused as titles, retried
+# batches) are then translated by the Cloud Translation API only once.
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class TranslationMemory:
+    def __init__(self, path, lru_size=10000):
+        # one connection shared by the request threads and the translation worker,
+        # None when the file cannot be opened: the memory is then only the LRU
+        self._conn = None
+        try:
+            conn = sqlite3.connect(path, check_same_thread=False)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS translation ("
+                " text_sha256 TEXT NOT NULL,"
+                " source_lang TEXT NOT NULL,"
+                " target_lang TEXT NOT NULL,"
+                " translated_text TEXT NOT NULL,"
+                " PRIMARY KEY (text_sha256, source_lang, target_lang))"
+            )
+            conn.commit()
+            self._conn = conn
+        except sqlite3.Error as e:
+            print("Translation memory at {} unavailable, keeping it in memory only: {}".format(path, e))
+        self._lru = LRUCache(maxsize=lru_size)
+        self._lock = threading.Lock()
+
+    def lookup(self, texts, source_lang, target_lang) -> dict:
+        """Return {text: translated text} for the given texts found in the memory"""
+        found = {}
+        missing = {}  # sha256 -> text
+        with self._lock:
+            for text in set(texts):
+                key = (text_key(text), source_lang, target_lang)
+                translated = self._lru.get(key)
+                if translated is None:
+                    missing[key[0]] = text
+                else:
+                    found[text] = translated
+            if missing and self._conn is not None:
+                hashes = list(missing)
+                # stay below SQLITE_MAX_VARIABLE_NUMBER
+                for start in range(0, len(hashes), 500):
+                    chunk = hashes[start:start + 500]
+                    rows = self._conn.execute(
+                        "SELECT text_sha256, translated_text FROM translation"
+                        " WHERE source_lang = ? AND target_lang = ? AND text_sha256 IN ({})"
+                        .format(",".join("?" * len(chunk))),
+                        [source_lang, target_lang] + chunk,
+                    )
+                    for sha, translated in rows:
+                        self._lru[(sha, source_lang, target_lang)] = translated
+                        found[missing[sha]] = translated
+        return found
+
+    def store(self, translations: dict, source_lang, target_lang):
+        """Remember {text: translated text}"""
+        rows = [(text_key(text), source_lang, target_lang, translated) for text, translated in translations.items()]
+        with self._lock:
+            if self._conn is not None:
+                self._conn.executemany("INSERT OR REPLACE INTO translation VALUES (?, ?, ?, ?)", rows)
+                self._conn.commit()
+            for sha, source, target, translated in rows:
+                self._lru[(sha, source, target)] = translated